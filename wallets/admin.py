@@ -11,18 +11,34 @@ class DeviceAdmin(admin.ModelAdmin):
         'device_library_identifier',
         'get_brand',
     )
+    list_filter = (
+        'platform',
+    )
 
     def get_brand(self, obj):
-        if len(obj.push_token) > 100:
-            return 'Android'
-        else:
-            return 'iPhone'
+        return obj.get_platform_display()
 
     get_brand.short_description = _('Brand')
+    get_brand.admin_order_field = 'platform'
 
 
 admin.site.register(Device, DeviceAdmin)
 
-admin.site.register(Log)
+
+class LogAdmin(admin.ModelAdmin):
+    list_display = (
+        '__str__',
+        'count',
+        'first_seen',
+        'last_seen',
+    )
+    readonly_fields = (
+        'count',
+        'first_seen',
+        'last_seen',
+    )
+
+
+admin.site.register(Log, LogAdmin)
 
 admin.site.register(Registration)
@@ -1,5 +1,23 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
 
 
 class WalletsConfig(AppConfig):
     name = 'wallets'
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        from .cache import invalidate_pass_metadata
+
+        post_save.connect(
+            invalidate_pass_metadata,
+            sender=settings.PASS_MODEL,
+            dispatch_uid='wallets_invalidate_pass_metadata'
+        )
+        post_delete.connect(
+            invalidate_pass_metadata,
+            sender=settings.PASS_MODEL,
+            dispatch_uid='wallets_invalidate_pass_metadata'
+        )
@@ -0,0 +1,284 @@
+"""
+Building and cache of signed .pkpass archives
+
+Archives are keyed by the digest of their manifest, which covers pass.json
+and every file of a pass, so an unchanged pass is not signed and zipped
+again
+"""
+import hashlib
+import os
+import struct
+import tempfile
+import zlib
+from functools import lru_cache
+from io import BytesIO
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+from .assets import Asset
+
+
+class ArchiveCache:
+    """
+    Base class of archive caches, counts hits and misses of the process
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, manifest: bytes, certificate: str) -> str:
+        """
+        Return the cache key of a manifest, the signing certificate is a
+        part of it so a renewed certificate does not hit old archives
+        """
+        digest = hashlib.sha1(manifest)
+        digest.update(certificate.encode())
+        digest.update(str(os.stat(certificate).st_mtime_ns).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        data = self._get(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def set(self, key: str, data: bytes):
+        self._set(key, data)
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, data):
+        raise NotImplementedError
+
+
+class DiskArchiveCache(ArchiveCache):
+    """
+    Archives stored as files in a local directory, the least recently
+    used archives are removed when there are more than max_entries
+    """
+
+    def __init__(self, location, max_entries=10000, cull_frequency=3):
+        super().__init__()
+        self.location = location
+        self.max_entries = max_entries
+        # 1 / cull_frequency of the archives are removed at a time
+        self.cull_frequency = cull_frequency
+        # the number of archives, counted once and then kept up to date
+        self._count = None
+        os.makedirs(location, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.location, key[:2], key + '.pkpass')
+
+    def _get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)  # the mtime is used as the last access time
+        return data
+
+    def _set(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written to a temporary file first, so readers never get
+        # a partial archive
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        is_new = not os.path.exists(path)
+        os.replace(tmp_path, path)
+        if self._count is None:  # counted with the new archive
+            self._count = sum(1 for _ in self._list())
+        elif is_new:
+            self._count += 1
+        if self._count > self.max_entries:
+            self._cull()
+
+    def _list(self):
+        for directory in os.scandir(self.location):
+            if directory.is_dir():
+                for entry in os.scandir(directory.path):
+                    if entry.name.endswith('.pkpass'):
+                        yield entry
+
+    def _cull(self):
+        entries = list(self._list())
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) // self.cull_frequency]:
+            try:
+                os.remove(entry.path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+        self._count = None
+
+
+class DjangoArchiveCache(ArchiveCache):
+    """
+    Archives stored in a Django cache, which evicts them by its own policy
+    """
+
+    def __init__(self, alias='default', timeout=None, key_prefix='wallets'):
+        super().__init__()
+        self.cache = caches[alias]
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    def _cache_key(self, key):
+        return '{}:archive:{}'.format(self.key_prefix, key)
+
+    def _get(self, key):
+        return self.cache.get(self._cache_key(key))
+
+    def _set(self, key, data):
+        self.cache.set(self._cache_key(key), data, self.timeout)
+
+
+BACKENDS = {
+    'disk': DiskArchiveCache,
+    'django': DjangoArchiveCache,
+}
+
+
+@lru_cache(maxsize=None)
+def get_archive_cache():
+    """
+    Return the archive cache set by WALLET_ARCHIVE_CACHE or None, e.g.
+    {'BACKEND': 'disk', 'OPTIONS': {'location': '/var/cache/passes'}}
+    """
+    config = getattr(settings, 'WALLET_ARCHIVE_CACHE', None)
+    if not config:
+        return None
+    try:
+        backend = BACKENDS[config['BACKEND']]
+    except KeyError:
+        raise ImproperlyConfigured(
+            'WALLET_ARCHIVE_CACHE BACKEND must be one of: {}'.format(
+                ', '.join(BACKENDS)
+            )
+        )
+    return backend(**config.get('OPTIONS', {}))
+
+
+# zip records, see the .ZIP File Format Specification (APPNOTE.TXT)
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_VERSION = 20
+# entries are dated 1980-01-01 00:00, so the same pass gives the same bytes
+DOS_TIME = 0
+DOS_DATE = (1 << 5) | 1
+UTF8_FLAG = 0x800
+# made on Unix, -rw-r--r--
+MADE_BY = (3 << 8) | ZIP_VERSION
+EXTERNAL_ATTRIBUTES = 0o100644 << 16
+
+
+class ArchiveBuilder:
+    """
+    Writes .pkpass zip files entry by entry
+
+    Text entries are deflated at level, files with stored_extensions (images
+    that are compressed already) are stored as they are. Assets keep their
+    deflated data and CRC, so shared files are compressed once per process
+    and copied raw into every archive.
+    """
+
+    def __init__(
+            self,
+            level=6,
+            stored_extensions=('.png', '.jpg', '.jpeg', '.gif')
+    ):
+        self.level = level
+        self.stored_extensions = tuple(stored_extensions)
+
+    def _compress(self, name, data):
+        """Return (method, crc32, compressed data, size) of an entry"""
+        if isinstance(data, Asset):
+            asset, data = data, data.data
+        else:
+            asset = None
+        crc = asset.crc32 if asset is not None else zlib.crc32(data)
+        if self.level == 0 or name.lower().endswith(self.stored_extensions):
+            return ZIP_STORED, crc, data, len(data)
+
+        if asset is not None:
+            compressed = asset.compressed(self.level)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) >= len(data):
+            return ZIP_STORED, crc, data, len(data)
+        return ZIP_DEFLATED, crc, compressed, len(data)
+
+    def build(self, entries) -> bytes:
+        """Return the zip file of (name, bytes or Asset) entries"""
+        archive = BytesIO()
+        central_directory = []
+        for name, data in entries:
+            method, crc, compressed, size = self._compress(name, data)
+            encoded_name = name.encode('utf-8')
+            flags = 0 if encoded_name.isascii() else UTF8_FLAG
+            header = (
+                ZIP_VERSION, flags, method, DOS_TIME, DOS_DATE,
+                crc, len(compressed), size, len(encoded_name)
+            )
+            central_directory.append(
+                CENTRAL_HEADER.pack(
+                    0x02014b50, MADE_BY, *header, 0, 0, 0, 0,
+                    EXTERNAL_ATTRIBUTES, archive.tell()
+                ) + encoded_name
+            )
+            archive.write(LOCAL_HEADER.pack(0x04034b50, *header, 0))
+            archive.write(encoded_name)
+            archive.write(compressed)
+
+        offset = archive.tell()
+        for record in central_directory:
+            archive.write(record)
+        archive.write(END_RECORD.pack(
+            0x06054b50, 0, 0,
+            len(central_directory),
+            len(central_directory),
+            archive.tell() - offset,
+            offset,
+            0
+        ))
+        return archive.getvalue()
+
+    def write(self, entries, zip_file):
+        """Write the zip file of entries to a path or a file object"""
+        data = self.build(entries)
+        if isinstance(zip_file, str):
+            with open(zip_file, 'wb') as f:
+                f.write(data)
+        else:
+            zip_file.write(data)
+
+
+@lru_cache(maxsize=None)
+def get_archive_builder() -> ArchiveBuilder:
+    """
+    Return the archive builder with the options of WALLET_ARCHIVE_BUILDER,
+    e.g. {'level': 9, 'stored_extensions': ['.png']}
+    """
+    return ArchiveBuilder(**getattr(settings, 'WALLET_ARCHIVE_BUILDER', {}))
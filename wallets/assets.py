@@ -0,0 +1,98 @@
+"""
+Files that are packed into passes
+
+Icons, logos and strip images are usually the same for every pass of a
+type, so they are loaded and hashed once per process and shared by
+the passes that use them
+"""
+import hashlib
+import os
+import threading
+import zlib
+
+
+class Asset:
+    """
+    Contents of a pass file with its SHA-1 for the manifest
+    """
+
+    def __init__(self, data: bytes, sha1: str = None, path: str = None):
+        self.data = data
+        self.sha1 = sha1 or hashlib.sha1(data).hexdigest()
+        # the file the asset was loaded from, if any
+        self.path = path
+        self._crc32 = None
+        self._compressed = {}
+
+    @property
+    def crc32(self) -> int:
+        if self._crc32 is None:
+            self._crc32 = zlib.crc32(self.data)
+        return self._crc32
+
+    def compressed(self, level: int = zlib.Z_DEFAULT_COMPRESSION) -> bytes:
+        """Return the data as a raw deflate stream, as stored in zip files"""
+        if level not in self._compressed:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            self._compressed[level] = (
+                compressor.compress(self.data) + compressor.flush()
+            )
+        return self._compressed[level]
+
+    def __reduce__(self):
+        # assets loaded from files are sent to worker processes by path,
+        # every worker then loads them once into its own registry
+        if self.path is not None:
+            return _get_asset, (self.path,)
+        return Asset, (self.data, self.sha1)
+
+
+class AssetRegistry:
+    """
+    Assets shared across the process, keyed by path and by content hash
+    """
+
+    def __init__(self):
+        self._by_path = {}
+        self._by_sha1 = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> Asset:
+        """
+        Return the asset of a file, the file is read again only when
+        it is modified
+        """
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        entry = self._by_path.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        asset = self.add(data, path=path)
+        with self._lock:
+            self._by_path[path] = (mtime, asset)
+        return asset
+
+    def add(self, data: bytes, path: str = None) -> Asset:
+        """Return the asset with the given contents"""
+        sha1 = hashlib.sha1(data).hexdigest()
+        with self._lock:
+            asset = self._by_sha1.get(sha1)
+            if asset is None:
+                asset = Asset(data, sha1, path)
+                self._by_sha1[sha1] = asset
+        return asset
+
+    def clear(self):
+        with self._lock:
+            self._by_path.clear()
+            self._by_sha1.clear()
+
+
+assets = AssetRegistry()
+
+
+def _get_asset(path):
+    return assets.get(path)
@@ -0,0 +1,221 @@
+"""
+Asynchronous versions of the web service views for ASGI servers,
+they are used when WALLET_ASYNC_VIEWS is set (Django 5.0+)
+"""
+import json
+from datetime import datetime
+from datetime import timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404
+from django.http import HttpRequest
+from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.utils.http import quote_etag
+from django.views.decorators.csrf import csrf_exempt
+
+from .models import Device
+from .models import get_pass_model
+from .cache import get_metadata_cache
+from .logs import get_log_buffer
+from .logs import save_logs
+from .throttling import throttled
+from .views import FORMAT
+from .views import device_passes
+from .views import get_pass_storage
+from .views import is_authorized
+from .views import log_buffer_full_response
+from .views import metadata_etag
+from .views import latest_passes
+from .views import pass_registered
+from .views import register_device
+from .views import pass_response
+from .views import pass_unregistered
+from .views import serial_numbers_response
+from .views import unregister_device
+
+CHUNK_SIZE = 64 * 1024
+
+
+async def get_pass(
+        pass_type_id: str,
+        serial_number: str
+) -> settings.PASS_MODEL:
+    """Return a pass or 404"""
+    pass_model = get_pass_model()
+    try:
+        return await pass_model.objects.aget(
+            pass_type_id=pass_type_id,
+            serial_number=serial_number
+        )
+    except pass_model.DoesNotExist:
+        raise Http404
+
+
+def open_file(name):
+    storage = get_pass_storage()
+    return storage.open(name, 'rb'), storage.size(name)
+
+
+async def read_chunks(file):
+    """Read a file in a thread without blocking the event loop"""
+    read = sync_to_async(file.read, thread_sensitive=False)
+    try:
+        while True:
+            chunk = await read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        await sync_to_async(file.close, thread_sensitive=False)()
+
+
+@csrf_exempt
+async def handle_device(
+        request: HttpRequest,
+        device_library_id: str,
+        pass_type_id: str,
+        serial_number: str,
+        platform: str = Device.IOS
+):
+    """
+    Handle a device request, register or unregister it
+    """
+    # we already have this card
+    metadata = await get_metadata_cache().aget(
+        request,
+        pass_type_id,
+        serial_number
+    )
+
+    if not is_authorized(request, metadata):
+        return HttpResponse(status=401)
+
+    # registering a device
+    if request.method == 'POST':
+        body = json.loads(request.body)
+        created = await sync_to_async(register_device)(
+            metadata.pk,
+            device_library_id,
+            body['pushToken'],
+            platform
+        )
+        if not created:  # already registered
+            return HttpResponse(status=200)
+
+        if pass_registered.receivers:
+            await pass_registered.asend(
+                sender=await get_pass(pass_type_id, serial_number)
+            )
+        return HttpResponse(status=201)  # Created
+
+    elif request.method == 'DELETE':
+        unregistered = await sync_to_async(unregister_device)(
+            metadata.pk,
+            device_library_id
+        )
+        if not unregistered:
+            return HttpResponse(status=404)
+
+        if pass_unregistered.receivers:
+            await pass_unregistered.asend(
+                sender=await get_pass(pass_type_id, serial_number)
+            )
+        return HttpResponse(status=200)
+
+    else:
+        return HttpResponse(status=400)
+
+
+@throttled
+async def get_serial_numbers(
+        request: HttpRequest,
+        device_library_id: str,
+        pass_type_id: str
+):
+    """
+    Get the Serial Numbers for passes associated with a device
+    """
+    passes = device_passes(device_library_id, pass_type_id)
+    updated_since = None
+    if 'passesUpdatedSince' in request.GET:
+        updated_since = datetime.strptime(
+            request.GET['passesUpdatedSince'], FORMAT
+        )
+
+    rows = [row async for row in latest_passes(passes, updated_since)]
+    if rows:
+        return serial_numbers_response(rows)
+    # the device or its passes are unknown
+    if not await passes.aexists():
+        return HttpResponse(status=404)
+    return HttpResponse(status=204)  # no content
+
+
+@throttled
+async def get_latest_version(
+        request: HttpRequest,
+        pass_type_id: str,
+        serial_number: str
+):
+    """
+    Get the latest version of pass
+    """
+    metadata = await get_metadata_cache().aget(
+        request,
+        pass_type_id,
+        serial_number
+    )
+
+    etag = metadata_etag(metadata)
+    if etag:
+        etag = quote_etag(etag)
+    utime = metadata.utime
+    if utime.tzinfo is None:
+        utime = utime.replace(tzinfo=timezone.utc)
+    last_modified = int(utime.timestamp())
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=last_modified
+    )
+    if response is None:
+        if not is_authorized(request, metadata):
+            return HttpResponse(status=401)
+
+        if getattr(settings, 'WALLET_SENDFILE_HEADER', None):
+            response = pass_response(metadata.data)
+        else:
+            file, size = await sync_to_async(open_file)(metadata.data)
+            response = StreamingHttpResponse(
+                read_chunks(file),
+                content_type='application/vnd.apple.pkpass'
+            )
+            response['Content-Length'] = size
+            response['Content-Disposition'] = (
+                'attachment; filename=pass.pkpass'
+            )
+
+    if request.method in ('GET', 'HEAD'):
+        if etag and not response.has_header('ETag'):
+            response['ETag'] = etag
+        if not response.has_header('Last-Modified'):
+            response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+@csrf_exempt
+async def log_info(request: HttpRequest):
+    """
+    Log messages from devices
+    """
+    body = json.loads(request.body)
+    log_buffer = get_log_buffer()
+    if log_buffer is None:
+        await sync_to_async(save_logs)(body['logs'])
+    elif not log_buffer.add(body['logs']):
+        return log_buffer_full_response()
+    return HttpResponse(status=200)
@@ -0,0 +1,232 @@
+"""
+Cache of the pass fields the web service needs to authorize requests
+and answer conditional GETs without loading the pass
+"""
+import threading
+import time
+from collections import OrderedDict
+from collections import namedtuple
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import Http404
+from django.http import HttpRequest
+
+from .models import get_pass_model
+from .throttling import flight
+
+# data is the name of the pass archive in the storage
+PassMetadata = namedtuple(
+    'PassMetadata',
+    ['pk', 'authentication_token', 'utime', 'data', 'content_digest']
+)
+FIELDS = ['pk', 'authentication_token', 'utime', 'data', 'content_digest']
+
+
+class LRUCache:
+    """
+    Bounded cache of the process with expiring entries, in front of the
+    shared cache of the metadata
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value, timeout=None):
+        self.set(key, value, timeout)
+
+
+class PassMetadataCache:
+    """
+    (pass_type_id, serial_number) -> PassMetadata, memoized per request
+    and kept in a Django cache shared by the processes. Entries may also
+    be kept in the process for local_timeout seconds, the other processes
+    then see a change that late.
+    """
+
+    def __init__(
+            self,
+            alias=None,
+            timeout=300,
+            local_timeout=0,
+            max_entries=10000
+    ):
+        # without a shared cache the metadata is read for every request
+        self.cache = caches[alias] if alias else None
+        self.timeout = timeout
+        self.local = LRUCache(max_entries) if local_timeout else None
+        self.local_timeout = local_timeout
+
+    @staticmethod
+    def key(pass_type_id: str, serial_number: str) -> str:
+        # v2 entries have the content digest
+        return 'wallets:pass:v2:{}:{}'.format(pass_type_id, serial_number)
+
+    @staticmethod
+    def _memo(request: HttpRequest) -> dict:
+        if request is None:
+            return {}
+        if not hasattr(request, '_wallet_pass_metadata'):
+            request._wallet_pass_metadata = {}
+        return request._wallet_pass_metadata
+
+    @staticmethod
+    def _query(pass_type_id, serial_number):
+        return get_pass_model().objects.filter(
+            pass_type_id=pass_type_id,
+            serial_number=serial_number
+        ).order_by().values_list(*FIELDS)
+
+    def _load(self, pass_type_id, serial_number):
+        return self._query(pass_type_id, serial_number).first()
+
+    async def _aload(self, pass_type_id, serial_number):
+        return await self._query(pass_type_id, serial_number).afirst()
+
+    def _cached(self, key):
+        metadata = None
+        if self.local is not None:
+            metadata = self.local.get(key)
+        if metadata is None and self.cache is not None:
+            metadata = self.cache.get(key)
+            if metadata is not None and self.local is not None:
+                self.local.set(key, metadata, self.local_timeout)
+        return metadata
+
+    async def _acached(self, key):
+        metadata = None
+        if self.local is not None:
+            metadata = await self.local.aget(key)
+        if metadata is None and self.cache is not None:
+            metadata = await self.cache.aget(key)
+            if metadata is not None and self.local is not None:
+                await self.local.aset(key, metadata, self.local_timeout)
+        return metadata
+
+    def _store(self, key, metadata):
+        if self.cache is not None:
+            self.cache.set(key, metadata, self.timeout)
+        if self.local is not None:
+            self.local.set(key, metadata, self.local_timeout)
+
+    async def _astore(self, key, metadata):
+        if self.cache is not None:
+            await self.cache.aset(key, metadata, self.timeout)
+        if self.local is not None:
+            await self.local.aset(key, metadata, self.local_timeout)
+
+    def get(
+            self,
+            request: HttpRequest,
+            pass_type_id: str,
+            serial_number: str
+    ) -> PassMetadata:
+        """Return the metadata of a pass or raise Http404"""
+        key = self.key(pass_type_id, serial_number)
+        memo = self._memo(request)
+        metadata = memo.get(key)
+        if metadata is None:
+            metadata = self._cached(key)
+            if metadata is None:
+                # concurrent misses of a pass share one query
+                row = flight.do(key, self._load, pass_type_id, serial_number)
+                if row is None:
+                    raise Http404
+                metadata = tuple(row)
+                self._store(key, metadata)
+            metadata = memo[key] = PassMetadata(*metadata)
+        return metadata
+
+    async def aget(
+            self,
+            request: HttpRequest,
+            pass_type_id: str,
+            serial_number: str
+    ) -> PassMetadata:
+        """Return the metadata of a pass or raise Http404"""
+        key = self.key(pass_type_id, serial_number)
+        memo = self._memo(request)
+        metadata = memo.get(key)
+        if metadata is None:
+            metadata = await self._acached(key)
+            if metadata is None:
+                row = await flight.ado(
+                    key,
+                    self._aload,
+                    pass_type_id,
+                    serial_number
+                )
+                if row is None:
+                    raise Http404
+                metadata = tuple(row)
+                await self._astore(key, metadata)
+            metadata = memo[key] = PassMetadata(*metadata)
+        return metadata
+
+    def invalidate(self, pass_type_id: str, serial_number: str):
+        key = self.key(pass_type_id, serial_number)
+        if self.cache is not None:
+            self.cache.delete(key)
+        if self.local is not None:
+            self.local.delete(key)
+
+
+@lru_cache(maxsize=None)
+def get_metadata_cache() -> PassMetadataCache:
+    """
+    Return the metadata cache, WALLET_METADATA_CACHE is the alias of a
+    Django cache shared by the processes (Redis, Memcached, database)
+    """
+    return PassMetadataCache(
+        alias=getattr(settings, 'WALLET_METADATA_CACHE', None),
+        timeout=getattr(settings, 'WALLET_METADATA_CACHE_TIMEOUT', 300),
+        local_timeout=getattr(
+            settings,
+            'WALLET_METADATA_CACHE_LOCAL_TIMEOUT',
+            0
+        ),
+    )
+
+
+def invalidate_pass_metadata(instance, using=None, **kwargs):
+    """
+    Drop the cached metadata of a saved or deleted pass once the change
+    is committed, so requests until then cannot cache it again
+    """
+    pass_type_id = instance.pass_type_id
+    serial_number = instance.serial_number
+    transaction.on_commit(
+        lambda: get_metadata_cache().invalidate(pass_type_id, serial_number),
+        using=using
+    )
@@ -0,0 +1,239 @@
+"""
+Push campaigns notify all the devices of a pass type, or of any device
+filter, at a bounded rate, e.g. after a design change of all the passes
+"""
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Exists
+from django.db.models import OuterRef
+
+from .models import Device
+from .models import Registration
+from .tasks import not_recently_pushed
+from .tasks import pass_push_android_batch
+from .tasks import pass_push_apple_batch
+
+
+class CampaignStats:
+    """Counters of a running campaign"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.tokens = 0  # distinct tokens read from the database
+        self.duplicates = 0
+        self.skipped = 0  # pushed by someone else during the campaign
+        self.sent = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def add(self, sent=0, failed=0):
+        with self._lock:
+            self.sent += sent
+            self.failed += failed
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self) -> float:
+        """Notifications per second"""
+        elapsed = self.elapsed
+        return (self.sent + self.failed) / elapsed if elapsed else 0.0
+
+    def __str__(self):
+        return (
+            '{} tokens, {} sent, {} failed, {} duplicates, {} skipped '
+            'in {:.0f}s ({:.0f}/s)'.format(
+                self.tokens,
+                self.sent,
+                self.failed,
+                self.duplicates,
+                self.skipped,
+                self.elapsed,
+                self.rate
+            )
+        )
+
+
+class RateLimiter:
+    """Paces a caller at rate units per second, 0 means no limit"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self.next = time.monotonic()
+
+    def wait(self, units=1):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self.next > now:
+            time.sleep(self.next - now)
+        self.next = max(self.next, now) + units * self.interval
+
+
+def campaign_devices(pass_type_id=None, devices=None):
+    """
+    Return the devices holding a pass of a type, each of them once
+    however many passes of the type it has
+    """
+    if devices is None:
+        devices = Device.objects.all()
+    if pass_type_id is not None:
+        devices = devices.filter(Exists(
+            Registration.objects.filter(
+                device=OuterRef('pk'),
+                pass_object__pass_type_id=pass_type_id
+            )
+        ))
+    return devices
+
+
+def token_chunks(devices, chunk_size: int, stats: CampaignStats):
+    """
+    Yield (platform, push tokens) chunks of the devices, read by keyset
+    pagination. Devices are unique, tokens repeated by several devices
+    are dropped within a chunk so memory stays bounded.
+    """
+    chunks = {platform: {} for platform, _ in Device.PLATFORM_CHOICES}
+    last_pk = 0
+    while True:
+        rows = list(
+            devices.filter(pk__gt=last_pk).order_by('pk').values_list(
+                'pk',
+                'platform',
+                'push_token'
+            )[:chunk_size]
+        )
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+        for _, platform, push_token in rows:
+            chunk = chunks[platform]
+            if push_token in chunk:
+                stats.duplicates += 1
+                continue
+            stats.tokens += 1
+            chunk[push_token] = None
+            if len(chunk) == chunk_size:
+                yield platform, list(chunk)
+                chunks[platform] = {}
+    for platform, chunk in chunks.items():
+        if chunk:
+            yield platform, list(chunk)
+
+
+def _send(platform, push_tokens) -> dict:
+    try:
+        if platform == Device.ANDROID:
+            # failed tokens are sent again by the campaign, retries
+            # dispatched with a countdown would not outlive it
+            return pass_push_android_batch(push_tokens, 0)
+        return pass_push_apple_batch(push_tokens)
+    finally:
+        close_old_connections()
+
+
+def _retryable(platform, status) -> bool:
+    return platform == Device.ANDROID and (status is None or status >= 500)
+
+
+def run_campaign(
+        pass_type_id=None,
+        devices=None,
+        rate=None,
+        concurrency=None,
+        chunk_size=None,
+        retries=3,
+        retry_delay=None,
+        progress=None,
+        progress_interval=5.0
+) -> CampaignStats:
+    """
+    Notify the devices of a pass type and/or a Device queryset
+
+    At most rate tokens per second (WALLET_CAMPAIGN_RATE) are sent, by
+    concurrency batches at a time (WALLET_CAMPAIGN_CONCURRENCY). The
+    batches run in this process so their results are counted, Android
+    tokens that failed because of the service are sent again retries
+    times, retry_delay seconds apart (WALLET_PUSH_RETRY_DELAY). progress
+    is called with the stats every progress_interval seconds and at the
+    end. Rejected tokens are pruned as by any push.
+    """
+    if rate is None:
+        rate = getattr(settings, 'WALLET_CAMPAIGN_RATE', 1000)
+    if concurrency is None:
+        concurrency = getattr(settings, 'WALLET_CAMPAIGN_CONCURRENCY', 4)
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'WALLET_PUSH_CHUNK_SIZE', 1000)
+    if retry_delay is None:
+        retry_delay = getattr(settings, 'WALLET_PUSH_RETRY_DELAY', 60)
+
+    stats = CampaignStats()
+    limiter = RateLimiter(rate)
+    since = time.time()
+    last_report = time.monotonic()
+    pending = {}
+    failed = []  # tokens to send again
+
+    def collect(done):
+        for future in done:
+            platform, push_tokens = pending.pop(future)
+            if future.exception() is not None:
+                statuses = dict.fromkeys(push_tokens)
+            else:
+                statuses = future.result()
+            for push_token, status in statuses.items():
+                if status == 200:
+                    stats.add(sent=1)
+                elif _retryable(platform, status):
+                    failed.append(push_token)
+                else:
+                    stats.add(failed=1)
+
+    def submit(platform, push_tokens):
+        nonlocal last_report
+        if len(pending) >= concurrency:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+        limiter.wait(len(push_tokens))
+        pending[executor.submit(_send, platform, push_tokens)] = (
+            platform,
+            push_tokens
+        )
+        if progress and time.monotonic() - last_report >= progress_interval:
+            progress(stats)
+            last_report = time.monotonic()
+
+    devices = campaign_devices(pass_type_id, devices)
+    with ThreadPoolExecutor(
+            max_workers=concurrency,
+            thread_name_prefix='wallets-campaign'
+    ) as executor:
+        for platform, chunk in token_chunks(devices, chunk_size, stats):
+            # tokens pushed since the start already made the devices update
+            fresh = not_recently_pushed(chunk, since)
+            stats.skipped += len(chunk) - len(fresh)
+            if fresh:
+                submit(platform, fresh)
+        collect(wait(pending).done)
+
+        for _ in range(retries):
+            if not failed:
+                break
+            push_tokens, failed[:] = failed[:], []
+            time.sleep(retry_delay)
+            for i in range(0, len(push_tokens), chunk_size):
+                submit(Device.ANDROID, push_tokens[i:i + chunk_size])
+            collect(wait(pending).done)
+    stats.add(failed=len(failed))
+
+    if progress:
+        progress(stats)
+    return stats
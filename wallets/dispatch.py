@@ -0,0 +1,203 @@
+"""
+Backends that run the push tasks, selected by WALLET_PUSH_BACKEND:
+'celery', 'thread', 'asyncio', 'sync' or the dotted path of a Dispatcher
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+try:
+    import celery  # in case a user has celery installed
+except ImportError:
+    celery = None
+
+logger = logging.getLogger(__name__)
+
+
+def run_task(task, *args):
+    """Run a task outside of a request, as a worker would"""
+    try:
+        task(*args)
+    except Exception:
+        logger.exception(
+            'Push task %s failed',
+            getattr(task, '__name__', task)
+        )
+    finally:
+        close_old_connections()
+
+
+class Dispatcher:
+    """
+    Runs tasks, countdown is the number of seconds to wait before
+    running one
+    """
+
+    def dispatch(self, task, *args, countdown=None):
+        raise NotImplementedError
+
+
+class CeleryDispatcher(Dispatcher):
+    """Send tasks to the Celery broker"""
+
+    def dispatch(self, task, *args, countdown=None):
+        task.apply_async(args, countdown=countdown)
+
+
+class SyncDispatcher(Dispatcher):
+    """Run tasks right away in the calling thread, countdowns are ignored"""
+
+    def dispatch(self, task, *args, countdown=None):
+        task(*args)
+
+
+class ThreadPoolDispatcher(Dispatcher):
+    """
+    Run tasks in a pool of threads of the process, at most max_pending
+    tasks wait for a thread, dispatching more blocks the caller. Tasks
+    with a countdown wait in a queue of one scheduler thread, at most
+    max_pending of them too.
+    """
+
+    def __init__(self, max_workers=4, max_pending=1000):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='wallets-push'
+        )
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.local = threading.local()
+        # heap of (due time, order, bounded, task, args)
+        self.delayed = []
+        self.delayed_slots = threading.BoundedSemaphore(max_pending)
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        threading.Thread(
+            target=self._run_delayed,
+            name='wallets-push-scheduler',
+            daemon=True
+        ).start()
+
+    def _run(self, task, *args):
+        self.local.in_pool = True
+        try:
+            run_task(task, *args)
+        finally:
+            self.slots.release()
+
+    def _submit(self, task, *args):
+        # a task of the pool that dispatches another one does not wait
+        # for a slot, a full pool would never free one, it runs it itself
+        in_pool = getattr(self.local, 'in_pool', False)
+        if not self.slots.acquire(blocking=not in_pool):
+            run_task(task, *args)
+            return
+        self.executor.submit(self._run, task, *args)
+
+    def _schedule(self, countdown, task, *args):
+        # the scheduler may wait for a slot of the pool, so a task of
+        # the pool does not wait for the scheduler, it goes over the bound
+        in_pool = getattr(self.local, 'in_pool', False)
+        bounded = self.delayed_slots.acquire(blocking=not in_pool)
+        with self.condition:
+            heapq.heappush(self.delayed, (
+                time.monotonic() + countdown,
+                next(self.order),
+                bounded,
+                task,
+                args
+            ))
+            self.condition.notify()
+
+    def _run_delayed(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    if self.delayed and self.delayed[0][0] <= now:
+                        break
+                    self.condition.wait(
+                        self.delayed[0][0] - now if self.delayed else None
+                    )
+                _, _, bounded, task, args = heapq.heappop(self.delayed)
+            if bounded:
+                self.delayed_slots.release()
+            self._submit(task, *args)
+
+    def dispatch(self, task, *args, countdown=None):
+        if countdown:
+            self._schedule(countdown, task, *args)
+        else:
+            self._submit(task, *args)
+
+
+class AsyncioDispatcher(Dispatcher):
+    """
+    Schedule tasks on an event loop running in a background thread,
+    the blocking tasks run in the loop's executor
+    """
+
+    def __init__(self, max_workers=4):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='wallets-push'
+        ))
+        threading.Thread(
+            target=self.loop.run_forever,
+            name='wallets-push-loop',
+            daemon=True
+        ).start()
+
+    def _run(self, task, *args):
+        self.loop.run_in_executor(None, run_task, task, *args)
+
+    def dispatch(self, task, *args, countdown=None):
+        if countdown:
+            self.loop.call_soon_threadsafe(
+                self.loop.call_later,
+                countdown,
+                self._run,
+                task,
+                *args
+            )
+        else:
+            self.loop.call_soon_threadsafe(self._run, task, *args)
+
+
+BACKENDS = {
+    'celery': CeleryDispatcher,
+    'thread': ThreadPoolDispatcher,
+    'asyncio': AsyncioDispatcher,
+    'sync': SyncDispatcher,
+}
+
+
+@lru_cache(maxsize=None)
+def get_dispatcher() -> Dispatcher:
+    """
+    Return the dispatcher of the process, Celery is used by default
+    when it is installed and a thread pool otherwise
+    """
+    backend = getattr(
+        settings,
+        'WALLET_PUSH_BACKEND',
+        'thread' if celery is None else 'celery'
+    )
+    options = getattr(settings, 'WALLET_PUSH_BACKEND_OPTIONS', {})
+    if backend in BACKENDS:
+        return BACKENDS[backend](**options)
+    return import_string(backend)(**options)
+
+
+def dispatch(task, *args, countdown=None):
+    """Run a task with the dispatcher of the process"""
+    get_dispatcher().dispatch(task, *args, countdown=countdown)
@@ -1,12 +1,24 @@
 import decimal
 import hashlib
 import json
-import subprocess
+import os
 import zipfile
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
 from io import BytesIO
+from itertools import islice
+from operator import attrgetter
 
 from django.conf import settings
 
+from . import signing
+from .archives import get_archive_builder
+from .archives import get_archive_cache
+from .assets import Asset
+from .assets import assets
+
 
 class Alignment:
     LEFT = 'PKTextAlignmentLeft'
@@ -46,7 +58,52 @@ class NumberStyle:
     SPELLOUT = 'PKNumberStyleSpellOut'
 
 
-class Field:
+class JsonObject:
+    """
+    Base of the objects of pass.json
+
+    json_keys lists (attribute, PassKit key, required) of a class, they are
+    merged with the keys of its parents into one getter once per class.
+    Optional values that are None or empty are left out.
+    """
+    __slots__ = ()
+    json_keys = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        keys = {}
+        for klass in reversed(cls.__mro__):
+            for attribute, key, required in vars(klass).get('json_keys', ()):
+                keys[attribute] = (key, required)
+        cls._json_keys = tuple(
+            (key, required) for key, required in keys.values()
+        )
+        # one C call reads all the values of an object
+        getter = attrgetter(*keys) if keys else (lambda obj: ())
+        cls._json_values = staticmethod(
+            getter if len(keys) != 1 else (lambda obj: (getter(obj),))
+        )
+
+    def json_dict(self):
+        return {
+            key: value
+            for (key, required), value in zip(
+                self._json_keys,
+                self._json_values(self)
+            )
+            if required or (value is not None and value != '')
+        }
+
+
+class Field(JsonObject):
+    __slots__ = ('key', 'value', 'label', 'change_message', 'text_alignment')
+    json_keys = (
+        ('key', 'key', True),
+        ('value', 'value', True),
+        ('label', 'label', False),
+        ('change_message', 'changeMessage', False),
+        ('text_alignment', 'textAlignment', False),
+    )
 
     def __init__(self, key, value, label=''):
 
@@ -58,11 +115,14 @@ class Field:
         self.change_message = ''
         self.text_alignment = Alignment.LEFT
 
-    def json_dict(self):
-        return self.__dict__
-
 
 class DateField(Field):
+    __slots__ = ('date_style', 'time_style', 'is_relative')
+    json_keys = (
+        ('date_style', 'dateStyle', False),
+        ('time_style', 'timeStyle', False),
+        ('is_relative', 'isRelative', False),
+    )
 
     def __init__(self, key, value, label=''):
         super().__init__(key, value, label)
@@ -71,31 +131,37 @@ class DateField(Field):
         # If true, the labels value is displayed as a relative date
         self.is_relative = False
 
-    def json_dict(self):
-        return self.__dict__
-
 
 class NumberField(Field):
+    __slots__ = ('number_style',)
+    json_keys = (
+        ('number_style', 'numberStyle', False),
+    )
 
     def __init__(self, key, value, label=''):
         super().__init__(key, value, label)
         self.number_style = NumberStyle.DECIMAL  # Style of date to display
 
-    def json_dict(self):
-        return self.__dict__
-
 
 class CurrencyField(Field):
+    __slots__ = ('currency_code',)
+    json_keys = (
+        ('currency_code', 'currencyCode', False),
+    )
 
     def __init__(self, key, value, label='', currency_code=''):
         super().__init__(key, value, label)
         self.currency_code = currency_code  # ISO 4217 currency code
 
-    def json_dict(self):
-        return self.__dict__
-
 
-class Barcode:
+class Barcode(JsonObject):
+    __slots__ = ('format', 'message', 'message_encoding', 'alt_text')
+    json_keys = (
+        ('format', 'format', True),
+        ('message', 'message', True),
+        ('message_encoding', 'messageEncoding', True),
+        ('alt_text', 'altText', False),
+    )
 
     def __init__(
             self,
@@ -109,13 +175,33 @@ class Barcode:
         self.message = message
         # Required. Text encoding that is used to convert the message
         self.message_encoding = 'iso-8859-1'
-        self.altText = alt_text  # Optional. Text displayed near the barcode
-
-    def json_dict(self):
-        return self.__dict__
-
-
-class Location:
+        self.alt_text = alt_text  # Optional. Text displayed near the barcode
+
+    # the attribute used to be named as the key
+    @property
+    def altText(self):
+        return self.alt_text
+
+    @altText.setter
+    def altText(self, value):
+        self.alt_text = value
+
+
+class Location(JsonObject):
+    __slots__ = (
+        'latitude',
+        'longitude',
+        'altitude',
+        'distance',
+        'relevant_text',
+    )
+    json_keys = (
+        ('latitude', 'latitude', True),
+        ('longitude', 'longitude', True),
+        ('altitude', 'altitude', False),
+        ('distance', 'distance', False),
+        ('relevant_text', 'relevantText', False),
+    )
 
     def __init__(self, latitude, longitude, altitude=0.0):
         # Required. Latitude, in degrees, of the location.
@@ -139,11 +225,16 @@ class Location:
         # the pass is currently near the location
         self.relevant_text = ''
 
-    def json_dict(self):
-        return self.__dict__
 
+class IBeacon(JsonObject):
+    __slots__ = ('proximity_uuid', 'major', 'minor', 'relevant_text')
+    json_keys = (
+        ('proximity_uuid', 'proximityUUID', True),
+        ('major', 'major', False),
+        ('minor', 'minor', False),
+        ('relevant_text', 'relevantText', False),
+    )
 
-class IBeacon(object):
     def __init__(self, proximity_uuid, major, minor):
         # IBeacon data
         self.proximity_uuid = proximity_uuid
@@ -153,11 +244,16 @@ class IBeacon(object):
         # Optional. Text message where near the ibeacon
         self.relevant_text = ''
 
-    def json_dict(self):
-        return self.__dict__
-
 
 class PassInformation:
+    # PassKit keys of the field lists, in the order they are rendered
+    field_keys = (
+        ('header_fields', 'headerFields'),
+        ('primary_fields', 'primaryFields'),
+        ('secondary_fields', 'secondaryFields'),
+        ('back_fields', 'backFields'),
+        ('auxiliary_fields', 'auxiliaryFields'),
+    )
 
     def __init__(self):
         self.header_fields = []
@@ -183,30 +279,10 @@ class PassInformation:
 
     def json_dict(self):
         d = {}
-        if self.header_fields:
-            d.update({
-                'header_fields': [f.json_dict() for f in self.header_fields]
-            })
-        if self.primary_fields:
-            d.update({
-                'primary_fields': [f.json_dict() for f in self.primary_fields]
-            })
-        if self.secondary_fields:
-            d.update({
-                'secondary_fields': [
-                    f.json_dict() for f in self.secondary_fields
-                ]
-            })
-        if self.back_fields:
-            d.update({
-                'back_fields': [f.json_dict() for f in self.back_fields]
-            })
-        if self.auxiliary_fields:
-            d.update({
-                'auxiliary_fields': [
-                    f.json_dict() for f in self.auxiliary_fields
-                ]
-            })
+        for attribute, key in self.field_keys:
+            fields = getattr(self, attribute)
+            if fields:
+                d[key] = [f.json_dict() for f in fields]
         return d
 
 
@@ -280,7 +356,7 @@ class Pass:
             voided=None
     ):
 
-        self._files = {}  # Holds the files to include in the .pkpass
+        self._files = {}  # Holds the assets to include in the .pkpass
         self._hashes = {}  # Holds the SHAs of the files array
 
         # Standard Keys
@@ -344,7 +420,14 @@ class Pass:
 
     # Adds file to the file array
     def add_file(self, name, fd):
-        self._files[name] = fd.read()
+        self._files[name] = Asset(fd.read())
+
+    # Adds a shared file (for example, a logo) to the file array, the file
+    # is read and hashed once per process
+    def add_asset(self, name, asset):
+        if not isinstance(asset, Asset):
+            asset = assets.get(asset)
+        self._files[name] = asset
 
     # Creates the actual .pkpass file
     def create(
@@ -354,32 +437,63 @@ class Pass:
         zip_file = settings.WALLET_PASS_PATH.format(self.serial_number)
         pass_json = self._create_pass_json()
         manifest = self._create_manifest(pass_json)
-        signature = self._create_signature(
+        if not zip_file:
+            zip_file = BytesIO()
+
+        archive_cache = get_archive_cache()
+        if archive_cache is None:
+            self._create_zip(
+                pass_json,
+                manifest,
+                self._sign(manifest),
+                zip_file=zip_file
+            )
+            return zip_file
+
+        # an unchanged pass is taken from the cache without signing
+        key = archive_cache.key(manifest, settings.WALLET_CERTIFICATE_PATH)
+        archive = archive_cache.get(key)
+        if archive is None:
+            buffer = BytesIO()
+            self._create_zip(
+                pass_json,
+                manifest,
+                self._sign(manifest),
+                zip_file=buffer
+            )
+            archive = buffer.getvalue()
+            archive_cache.set(key, archive)
+        if isinstance(zip_file, str):
+            with open(zip_file, 'wb') as f:
+                f.write(archive)
+        else:
+            zip_file.write(archive)
+        return zip_file
+
+    def _sign(self, manifest):
+        return self._create_signature(
             manifest,
             settings.WALLET_CERTIFICATE_PATH,
             settings.WALLET_KEY_PATH,
             settings.WALLET_WWDR_PATH,
             settings.WALLET_PASSWORD,
         )
-        if not zip_file:
-            zip_file = BytesIO()
-        self._create_zip(
-            pass_json,
-            manifest,
-            signature,
-            zip_file=zip_file
-        )
-        return zip_file
 
     def _create_pass_json(self):
-        return json.dumps(self, default=pass_handler).encode('utf-8')
+        # the objects are serialized by json_dict, the default only
+        # handles the values of user_info etc.
+        return json.dumps(
+            self.json_dict(),
+            default=pass_handler,
+            separators=(',', ':')
+        ).encode('utf-8')
 
     # creates the hashes for the files and adds them into a json string.
     def _create_manifest(self, pass_json):
         # Creates SHA hashes for all files in package
         self._hashes['pass.json'] = hashlib.sha1(pass_json).hexdigest()
-        for filename, filedata in self._files.items():
-            self._hashes[filename] = hashlib.sha1(filedata).hexdigest()
+        for filename, asset in self._files.items():
+            self._hashes[filename] = asset.sha1
         return json.dumps(self._hashes).encode('utf-8')
 
     # Creates a signature and saves it
@@ -391,44 +505,25 @@ class Pass:
             wwdr_certificate,
             password
     ):
-        openssl_cmd = [
-            'openssl',
-            'smime',
-            '-binary',
-            '-sign',
-            '-certfile',
-            wwdr_certificate,
-            '-signer',
+        return signing.sign(
+            manifest,
             certificate,
-            '-inkey',
             key,
-            '-outform',
-            'DER',
-            '-passin',
-            'pass:{}'.format(password),
-        ]
-        process = subprocess.Popen(
-            openssl_cmd,
-            stderr=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
+            wwdr_certificate,
+            password
         )
-        process.stdin.write(manifest)
-        der, error = process.communicate()
-        if process.returncode != 0:
-            raise Exception(error)
-
-        return der
 
     # Creates .pkpass (zip archive)
     def _create_zip(self, pass_json, manifest, signature, zip_file=None):
-        zf = zipfile.ZipFile(zip_file or 'pass.pkpass', 'w')
-        zf.writestr('signature', signature)
-        zf.writestr('manifest.json', manifest)
-        zf.writestr('pass.json', pass_json)
-        for filename, filedata in self._files.items():
-            zf.writestr(filename, filedata)
-        zf.close()
+        get_archive_builder().write(
+            [
+                ('signature', signature),
+                ('manifest.json', manifest),
+                ('pass.json', pass_json),
+                *self._files.items(),
+            ],
+            zip_file or 'pass.pkpass'
+        )
 
     def json_dict(self):
         d = {
@@ -442,7 +537,7 @@ class Pass:
             self.pass_information.json_name: self.pass_information.json_dict()
         }
         if self.barcode:
-            d.update({'barcode': self.barcode.json_dict()})
+            d.update({'barcode': pass_handler(self.barcode)})
         if self.relevant_date:
             d.update({'relevantDate': self.relevant_date})
         if self.background_color:
@@ -454,9 +549,17 @@ class Pass:
         if self.logo_text:
             d.update({'logoText': self.logo_text})
         if self.locations:
-            d.update({'locations': self.locations})
+            d.update({
+                'locations': [
+                    pass_handler(location) for location in self.locations
+                ]
+            })
         if self.ibeacons:
-            d.update({'beacons': self.ibeacons})
+            d.update({
+                'beacons': [
+                    pass_handler(ibeacon) for ibeacon in self.ibeacons
+                ]
+            })
         if self.user_info:
             d.update({'userInfo': self.user_info})
         if self.associated_store_identifiers:
@@ -475,6 +578,12 @@ class Pass:
         return d
 
 
+def content_digest(zip_file) -> str:
+    """Return the SHA-1 of the manifest of a .pkpass archive"""
+    with zipfile.ZipFile(zip_file) as zf:
+        return hashlib.sha1(zf.read('manifest.json')).hexdigest()
+
+
 def pass_handler(obj):
     if hasattr(obj, 'json_dict'):
         return obj.json_dict()
@@ -484,3 +593,65 @@ def pass_handler(obj):
             return str(obj)
         else:
             return obj
+
+
+# The outcome of creating a pass with create_many, zip_file is what
+# Pass.create returned (bytes for in-memory archives), error is the
+# exception raised while creating it
+PassResult = namedtuple('PassResult', ['pass_', 'zip_file', 'error'])
+
+
+def _create_pass(pass_):
+    zip_file = pass_.create()
+    if isinstance(zip_file, BytesIO):
+        zip_file = zip_file.getvalue()
+    return zip_file
+
+
+def create_many(passes, workers=None, max_pending=None, executor=None):
+    """
+    Create .pkpass files for many passes across a process pool
+
+    Results are yielded as PassResult as soon as they are finished, so the
+    order is not preserved. A failed pass is reported in its result and
+    does not stop the batch. At most max_pending passes are sent to the
+    workers at a time, so passes may be a generator of any size. An
+    executor given is used instead of a new pool and left running, so
+    its workers keep their keys and assets loaded for the next call.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 4
+
+    if executor is not None:
+        yield from _create_in(executor, passes, max_pending)
+        return
+
+    if workers == 1:
+        for pass_ in passes:
+            try:
+                yield PassResult(pass_, _create_pass(pass_), None)
+            except Exception as e:
+                yield PassResult(pass_, None, e)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from _create_in(executor, passes, max_pending)
+
+
+def _create_in(executor, passes, max_pending):
+    passes = iter(passes)
+    pending = {}
+    while True:
+        for pass_ in islice(passes, max_pending - len(pending)):
+            pending[executor.submit(_create_pass, pass_)] = pass_
+        if not pending:
+            break
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pass_ = pending.pop(future)
+            error = future.exception()
+            yield PassResult(
+                pass_,
+                None if error else future.result(),
+                error
+            )
@@ -0,0 +1,176 @@
+"""
+Storage of the logs that are sent by devices
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+from collections import defaultdict
+from collections import deque
+from datetime import datetime
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db import transaction
+from django.db.models import F
+
+from .models import Log
+
+logger = logging.getLogger(__name__)
+
+
+def save_logs(messages, batch_size=500):
+    """
+    Save log messages, a known message only gets its count and
+    last seen time updated
+    """
+    now = datetime.now()
+    counts = Counter(messages)
+    hashes = {message: Log.hash_message(message) for message in counts}
+    # messages are grouped by count, so the counters of most of them
+    # are updated by a few queries
+    by_count = defaultdict(list)
+    for message, count in counts.items():
+        by_count[count].append(hashes[message])
+
+    with transaction.atomic():
+        Log.objects.bulk_create(
+            [
+                Log(
+                    message=message,
+                    message_hash=hashes[message],
+                    count=0,
+                    first_seen=now,
+                    last_seen=now
+                )
+                for message in counts
+            ],
+            batch_size=batch_size,
+            ignore_conflicts=True
+        )
+        for count, message_hashes in by_count.items():
+            for i in range(0, len(message_hashes), batch_size):
+                Log.objects.filter(
+                    message_hash__in=message_hashes[i:i + batch_size]
+                ).update(
+                    count=F('count') + count,
+                    last_seen=now
+                )
+
+
+def compact_logs(older_than: datetime, batch_size=1000) -> int:
+    """
+    Delete the logs last seen before a time in batches,
+    return the number of deleted logs
+    """
+    deleted = 0
+    while True:
+        pks = list(
+            Log.objects.filter(
+                last_seen__lt=older_than
+            ).order_by().values_list('pk', flat=True)[:batch_size]
+        )
+        if not pks:
+            return deleted
+        deleted += Log.objects.filter(pk__in=pks).delete()[0]
+
+
+class LogBuffer:
+    """
+    Bounded write-behind buffer of log messages
+
+    Messages are saved by a background thread in batches, when flush_size
+    messages are waiting or every flush_interval seconds. A full buffer
+    rejects new messages instead of growing.
+    """
+
+    def __init__(self, max_size=10000, flush_size=500, flush_interval=5.0):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._messages = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def add(self, messages) -> bool:
+        """Queue messages, return False if the buffer is full"""
+        if len(messages) > self.max_size:
+            # such a request would never fit, it is cut instead
+            logger.warning(
+                '%d device log messages dropped, more than the buffer holds',
+                len(messages) - self.max_size
+            )
+            messages = messages[:self.max_size]
+        with self._condition:
+            if len(self._messages) + len(messages) > self.max_size:
+                return False
+            self._messages.extend(messages)
+            if self._thread is None:
+                self._start()
+            if len(self._messages) >= self.flush_size:
+                self._condition.notify()
+        return True
+
+    def flush(self):
+        """Save all the queued messages"""
+        while True:
+            with self._condition:
+                batch = [
+                    self._messages.popleft()
+                    for _ in range(min(self.flush_size, len(self._messages)))
+                ]
+            if not batch:
+                return
+            try:
+                save_logs(batch, self.flush_size)
+            except Exception:
+                self._requeue(batch)
+                raise
+
+    def _requeue(self, batch):
+        """Put back a batch that could not be saved, as much as fits"""
+        with self._condition:
+            kept = batch[:max(0, self.max_size - len(self._messages))]
+            self._messages.extendleft(reversed(kept))
+        if len(kept) < len(batch):
+            logger.error(
+                '%d device log messages were lost',
+                len(batch) - len(kept)
+            )
+
+    def _start(self):
+        self._thread = threading.Thread(
+            target=self._run,
+            name='wallets-log-buffer',
+            daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if len(self._messages) < self.flush_size:
+                    self._condition.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Device logs could not be saved')
+                # the messages are kept, they are saved again later
+                time.sleep(self.flush_interval)
+            finally:
+                close_old_connections()
+
+
+@lru_cache(maxsize=None)
+def get_log_buffer():
+    """
+    Return the log buffer set by WALLET_LOG_BUFFER or None, e.g.
+    {'max_size': 10000, 'flush_size': 500, 'flush_interval': 5.0}
+    """
+    options = getattr(settings, 'WALLET_LOG_BUFFER', None)
+    if options is None:
+        return None
+    return LogBuffer(**options)
@@ -0,0 +1,32 @@
+from datetime import datetime
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from wallets.logs import compact_logs
+
+
+class Command(BaseCommand):
+    help = 'Delete device logs that were not seen for a number of days'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=getattr(settings, 'WALLET_LOG_RETENTION_DAYS', 30),
+            help='Keep the logs seen within this number of days',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of logs deleted per query',
+        )
+
+    def handle(self, *args, **options):
+        deleted = compact_logs(
+            datetime.now() - timedelta(days=options['days']),
+            batch_size=options['batch_size']
+        )
+        self.stdout.write('Deleted {} logs'.format(deleted))
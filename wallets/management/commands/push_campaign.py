@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from wallets.campaigns import run_campaign
+from wallets.models import Device
+
+
+class Command(BaseCommand):
+    help = 'Notify all the devices holding a pass of a type'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pass-type-id',
+            default=getattr(settings, 'WALLET_PASS_TYPE_ID', None),
+            help='Notify the devices of the passes of this type',
+        )
+        parser.add_argument(
+            '--platform',
+            choices=[platform for platform, _ in Device.PLATFORM_CHOICES],
+            help='Notify only the devices of this platform',
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=getattr(settings, 'WALLET_CAMPAIGN_RATE', 1000),
+            help='Push tokens sent per second, 0 for no limit',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=getattr(settings, 'WALLET_CAMPAIGN_CONCURRENCY', 4),
+            help='Batches of push tokens sent at the same time',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=getattr(settings, 'WALLET_PUSH_CHUNK_SIZE', 1000),
+            help='Push tokens per batch',
+        )
+        parser.add_argument(
+            '--retries',
+            type=int,
+            default=3,
+            help='Times Android tokens that failed because of the service '
+                 'are sent again',
+        )
+        parser.add_argument(
+            '--progress-interval',
+            type=float,
+            default=10.0,
+            help='Seconds between progress reports',
+        )
+
+    def handle(self, *args, **options):
+        devices = Device.objects.all()
+        if options['platform']:
+            devices = devices.filter(platform=options['platform'])
+
+        run_campaign(
+            pass_type_id=options['pass_type_id'],
+            devices=devices,
+            rate=options['rate'],
+            concurrency=options['concurrency'],
+            chunk_size=options['chunk_size'],
+            retries=options['retries'],
+            progress=lambda stats: self.stdout.write(str(stats)),
+            progress_interval=options['progress_interval']
+        )
+        self.stdout.write(self.style.SUCCESS('Done'))
@@ -0,0 +1,269 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from wallets.cache import get_metadata_cache
+from wallets.campaigns import RateLimiter
+from wallets.dispatch import dispatch
+from wallets.lib import content_digest
+from wallets.lib import create_many
+from wallets.models import get_pass_model
+from wallets.tasks import pass_push_fan_out
+
+
+class Command(BaseCommand):
+    help = (
+        'Build the pass files of all the passes (of a type) again, '
+        'e.g. after a design or certificate change'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pass-type-id',
+            help='Reissue only the passes of this type',
+        )
+        parser.add_argument(
+            '--builder',
+            default=getattr(settings, 'WALLET_PASS_BUILDER', None),
+            help='Dotted path of a callable that returns a wallets.lib.Pass '
+                 'for a pass model instance (WALLET_PASS_BUILDER)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Number of processes that build passes (all CPUs)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of passes loaded and saved at a time',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            default='reissue_passes.json',
+            help='File that records the progress of an interrupted run, '
+                 'removed when it is complete',
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore the checkpoint and start from the first pass',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Save every pass, also those with an unchanged manifest '
+                 '(e.g. after a certificate change)',
+        )
+        parser.add_argument(
+            '--push',
+            action='store_true',
+            help='Notify the devices of the changed passes',
+        )
+        parser.add_argument(
+            '--push-rate',
+            type=float,
+            default=0,
+            help='Passes notified per second, 0 for no limit',
+        )
+        parser.add_argument(
+            '--delete-delay',
+            type=float,
+            default=getattr(
+                settings,
+                'WALLET_METADATA_CACHE_LOCAL_TIMEOUT',
+                0
+            ) + 60,
+            help='Seconds replaced files are kept for requests that '
+                 'still use them',
+        )
+
+    def handle(self, *args, **options):
+        if not options['builder']:
+            raise CommandError(
+                'Set WALLET_PASS_BUILDER or pass --builder'
+            )
+        self.builder = import_string(options['builder'])
+        self.workers = options['workers'] or os.cpu_count() or 1
+        self.force = options['force']
+        self.push = options['push']
+        # pushes are paced here, dispatch countdowns do not outlive
+        # the command with the thread backend
+        self.push_limiter = RateLimiter(options['push_rate'])
+        self.delete_delay = options['delete_delay']
+
+        checkpoint_path = options['checkpoint']
+        checkpoint = {'pass_type_id': options['pass_type_id'],
+                      'last_pk': None, 'changed': 0, 'unchanged': 0,
+                      'failed': 0, 'replaced_files': []}
+        if not options['restart'] and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                saved = json.load(f)
+            if saved.get('pass_type_id') != options['pass_type_id']:
+                raise CommandError(
+                    '{} is the checkpoint of a reissue of pass type {}, '
+                    'pass --restart or another --checkpoint'.format(
+                        checkpoint_path,
+                        saved.get('pass_type_id') or 'all'
+                    )
+                )
+            checkpoint.update(saved)
+            self.stdout.write(
+                'Resuming after pass {}'.format(checkpoint['last_pk'])
+            )
+
+        passes = get_pass_model().objects.order_by('pk')
+        if options['pass_type_id']:
+            passes = passes.filter(pass_type_id=options['pass_type_id'])
+
+        # one pool for the whole run, its workers keep the signer and
+        # the assets loaded from a batch to the next
+        if self.workers > 1:
+            pool = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            pool = nullcontext()
+        with pool as self.executor:
+            while True:
+                # keyset pagination, the pages do not get slower further on
+                page = passes
+                if checkpoint['last_pk'] is not None:
+                    page = page.filter(pk__gt=checkpoint['last_pk'])
+                batch = list(page[:options['batch_size']].iterator())
+                if not batch:
+                    break
+
+                counts, replaced_files = self.reissue(batch)
+                for key, count in counts.items():
+                    checkpoint[key] += count
+                checkpoint['replaced_files'] = self.delete_files(
+                    checkpoint['replaced_files'] + replaced_files
+                )
+                checkpoint['last_pk'] = batch[-1].pk
+                self.save_checkpoint(checkpoint_path, checkpoint)
+                self.stdout.write(
+                    '{last_pk}: {changed} changed, {unchanged} unchanged, '
+                    '{failed} failed'.format(**checkpoint)
+                )
+
+        replaced_files = checkpoint['replaced_files']
+        if replaced_files:
+            wait = replaced_files[-1][1] + self.delete_delay - time.time()
+            self.stdout.write(
+                'Deleting the replaced files in {:.0f}s'.format(max(wait, 0))
+            )
+            time.sleep(max(wait, 0))
+            self.delete_files(replaced_files)
+        # the run is complete, the next one starts from the first pass
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        self.stdout.write(self.style.SUCCESS('Done'))
+
+    def reissue(self, batch) -> tuple:
+        """
+        Build and save a batch of passes, return the counts and the
+        replaced files
+        """
+        counts = {'changed': 0, 'unchanged': 0, 'failed': 0}
+        instances = {}
+        lib_passes = []
+        for instance in batch:
+            try:
+                lib_pass = self.builder(instance)
+            except Exception as e:
+                self.stderr.write('{}: {}'.format(instance, e))
+                counts['failed'] += 1
+                continue
+            instances[id(lib_pass)] = instance
+            lib_passes.append(lib_pass)
+
+        changed = []
+        old_files = []
+        now = datetime.now()
+        for result in create_many(
+                lib_passes,
+                workers=self.workers,
+                executor=self.executor
+        ):
+            instance = instances[id(result.pass_)]
+            if result.error is not None:
+                self.stderr.write('{}: {}'.format(instance, result.error))
+                counts['failed'] += 1
+                continue
+
+            data = result.zip_file
+            if isinstance(data, str):  # a file of WALLET_PASS_PATH
+                with open(data, 'rb') as f:
+                    data = f.read()
+                os.remove(result.zip_file)
+            digest = content_digest(BytesIO(data))
+            # the manifest does not cover the signature, a new
+            # certificate needs --force
+            if digest == instance.content_digest and not self.force:
+                counts['unchanged'] += 1
+                continue
+
+            if instance.data:
+                old_files.append(instance.data.name)
+            instance.data.save(
+                'pass{}.pkpass'.format(instance.serial_number),
+                ContentFile(data),
+                save=False
+            )
+            instance.content_digest = digest
+            instance.utime = now
+            changed.append(instance)
+        counts['changed'] = len(changed)
+
+        # bulk_update sends no post_save, the cache and the devices
+        # are updated here
+        with transaction.atomic():
+            get_pass_model().objects.bulk_update(
+                changed,
+                ['data', 'content_digest', 'utime']
+            )
+        metadata_cache = get_metadata_cache()
+        for instance in changed:
+            metadata_cache.invalidate(
+                instance.pass_type_id,
+                instance.serial_number
+            )
+        if self.push:
+            for instance in changed:
+                self.push_limiter.wait()
+                dispatch(pass_push_fan_out, instance.pk)
+        # requests that read the old names before may still open them
+        replaced_at = time.time()
+        return counts, [[name, replaced_at] for name in old_files]
+
+    def delete_files(self, replaced_files) -> list:
+        """Delete the files replaced delete_delay ago, return the others"""
+        storage = get_pass_model()._meta.get_field('data').storage
+        deadline = time.time() - self.delete_delay
+        kept = []
+        for name, replaced_at in replaced_files:
+            if replaced_at <= deadline:
+                storage.delete(name)
+            else:
+                kept.append([name, replaced_at])
+        return kept
+
+    @staticmethod
+    def save_checkpoint(path, checkpoint):
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.PASS_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Device',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_library_identifier', models.CharField(max_length=50, unique=True, verbose_name='Device identifier')),
+                ('push_token', models.CharField(max_length=250, verbose_name='Push token')),
+            ],
+            options={
+                'verbose_name': 'Connected device',
+                'verbose_name_plural': 'Connected devices',
+                'ordering': ['-pk'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Log',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message', models.TextField(verbose_name='Message')),
+            ],
+            options={
+                'verbose_name': 'Log',
+                'verbose_name_plural': 'Logs',
+                'ordering': ['-pk'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Registration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wallets.device', verbose_name='Associated device')),
+                ('pass_object', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.PASS_MODEL, verbose_name='Apple Wallet pass')),
+            ],
+            options={
+                'verbose_name': 'Relation: pass - device',
+                'verbose_name_plural': 'Relations: pass - device',
+                'ordering': ['-pk'],
+                'indexes': [models.Index(fields=['device', 'pass_object'], name='wallets_reg_device_pass_idx')],
+                'unique_together': {('pass_object', 'device')},
+            },
+        ),
+    ]
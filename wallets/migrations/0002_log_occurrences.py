@@ -0,0 +1,86 @@
+import datetime
+import hashlib
+
+from django.db import migrations, models
+
+
+def merge_duplicate_logs(apps, schema_editor):
+    """Count repeated messages in the row of their first occurrence"""
+    Log = apps.get_model('wallets', 'Log')
+    last_pk = 0
+    while True:
+        rows = list(Log.objects.filter(pk__gt=last_pk).order_by('pk').only(
+            'pk',
+            'message'
+        )[:2000])
+        if not rows:
+            break
+        for row in rows:
+            row.message_hash = hashlib.sha1(row.message.encode()).hexdigest()
+        Log.objects.bulk_update(rows, ['message_hash'])
+        last_pk = rows[-1].pk
+
+    # a batch of repeated messages at a time, in the order of the index
+    last_hash = ''
+    while True:
+        repeated = list(
+            Log.objects.filter(message_hash__gt=last_hash).values(
+                'message_hash'
+            ).annotate(
+                first=models.Min('pk'),
+                total=models.Count('pk')
+            ).filter(total__gt=1).order_by('message_hash')[:1000]
+        )
+        if not repeated:
+            break
+        Log.objects.filter(
+            message_hash__in=[group['message_hash'] for group in repeated]
+        ).exclude(
+            pk__in=[group['first'] for group in repeated]
+        ).delete()
+        Log.objects.bulk_update(
+            [Log(pk=group['first'], count=group['total'])
+             for group in repeated],
+            ['count']
+        )
+        last_hash = repeated[-1]['message_hash']
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='log',
+            name='message_hash',
+            field=models.CharField(db_index=True, editable=False, max_length=40, null=True, verbose_name='Message hash'),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='count',
+            field=models.PositiveIntegerField(default=1, verbose_name='Occurrences'),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='first_seen',
+            field=models.DateTimeField(default=datetime.datetime.now, verbose_name='First seen at'),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='last_seen',
+            field=models.DateTimeField(db_index=True, default=datetime.datetime.now, verbose_name='Last seen at'),
+        ),
+        migrations.RunPython(merge_duplicate_logs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='log',
+            name='message_hash',
+            field=models.CharField(editable=False, max_length=40, unique=True, verbose_name='Message hash'),
+        ),
+        migrations.AlterModelOptions(
+            name='log',
+            options={'ordering': ['-last_seen'], 'verbose_name': 'Log', 'verbose_name_plural': 'Logs'},
+        ),
+    ]
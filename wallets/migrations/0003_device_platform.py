@@ -0,0 +1,28 @@
+from django.db import migrations, models
+from django.db.models.functions import Length
+
+
+def set_platform(apps, schema_editor):
+    """Android push tokens are longer than Apple ones"""
+    Device = apps.get_model('wallets', 'Device')
+    Device.objects.annotate(
+        push_token_length=Length('push_token')
+    ).filter(
+        push_token_length__gt=100
+    ).update(platform='android')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0002_log_occurrences'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='platform',
+            field=models.CharField(choices=[('ios', 'iPhone'), ('android', 'Android')], db_index=True, default='ios', max_length=10, verbose_name='Platform'),
+        ),
+        migrations.RunPython(set_platform, migrations.RunPython.noop),
+    ]
@@ -2,12 +2,22 @@
 The models are built in accordance to the Wallet Developer Guide
 https://developer.apple.com/library/archive/documentation/UserExperience/Conceptual/PassKit_PG/Updating.html#//apple_ref/doc/uid/TP40012195-CH5-SW1
 """
+import hashlib
+import zipfile
 from datetime import datetime
 
+from django.apps import apps
 from django.db import models
 from django.conf import settings
 from django.utils.translation import gettext as _
 
+from .lib import content_digest
+
+
+def get_pass_model():
+    """Return the pass model set by PASS_MODEL"""
+    return apps.get_model(settings.PASS_MODEL, require_ready=False)
+
 
 class PassAbstract(models.Model):
     """
@@ -38,6 +48,14 @@ class PassAbstract(models.Model):
         default=datetime.now,
         verbose_name=_('Updated at')
     )
+    # SHA-1 of the manifest of the pass file, it covers pass.json
+    # and all the images
+    content_digest = models.CharField(
+        max_length=40,
+        blank=True,
+        editable=False,
+        verbose_name=_('Content digest')
+    )
 
     def __str__(self):
         return '{} ({})'.format(
@@ -45,9 +63,79 @@ class PassAbstract(models.Model):
             self.serial_number
         )
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_utime = instance.__dict__.get('utime')
+        instance._loaded_data = instance.__dict__.get('data')
+        return instance
+
+    def _data_replaced(self) -> bool:
+        """Tell if data is a new file or another stored one"""
+        return (
+            self._state.adding
+            or not self.data._committed
+            or self.data.name != getattr(self, '_loaded_data', None)
+        )
+
+    def _read_content_digest(self) -> str:
+        if not self.data:
+            return ''
+        committed = self.data._committed
+        self.data.open('rb')
+        try:
+            return content_digest(self.data)
+        except (zipfile.BadZipFile, KeyError):
+            return ''
+        finally:
+            if committed:
+                self.data.close()
+            else:  # the file is saved to the storage after this
+                self.data.seek(0)
+
+    def save(self, *args, **kwargs):
+        """
+        Update utime only when the content of the pass file changes,
+        content_changed tells the post_save handlers if it did
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'data' not in update_fields:
+            self.content_changed = False
+            super().save(*args, **kwargs)
+            return
+
+        # the archive is only read when it may have changed
+        if self._data_replaced():
+            digest = self._read_content_digest()
+            self.content_changed = (
+                self._state.adding or digest != self.content_digest
+            )
+        else:
+            self.content_changed = False
+        if self.content_changed:
+            self.content_digest = digest
+            if not self._state.adding:
+                self.utime = datetime.now()
+        elif getattr(self, '_loaded_utime', None) is not None:
+            # devices must not download the same pass again
+            self.utime = self._loaded_utime
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {
+                'content_digest',
+                'utime',
+            }
+        super().save(*args, **kwargs)
+        self._loaded_utime = self.utime
+        self._loaded_data = self.data.name
+
     class Meta:
         abstract = True
         unique_together = [['pass_type_id', 'serial_number']]
+        indexes = [
+            # passes of a type updated since the last request of a device,
+            # Django names it after the concrete model (within 30 characters)
+            models.Index(fields=['pass_type_id', 'utime']),
+        ]
         ordering = ['-pk']
         verbose_name = _('Apple Wallet Pass')
         verbose_name_plural = _('Apple Wallet Passes')
@@ -57,6 +145,13 @@ class Device(models.Model):
     """
     Device that passes are associated with
     """
+    IOS = 'ios'
+    ANDROID = 'android'
+    PLATFORM_CHOICES = [
+        (IOS, _('iPhone')),
+        (ANDROID, _('Android')),
+    ]
+
     device_library_identifier = models.CharField(
         max_length=50,
         verbose_name=_('Device identifier'),
@@ -66,6 +161,13 @@ class Device(models.Model):
         max_length=250,
         verbose_name=_('Push token')
     )
+    platform = models.CharField(
+        max_length=10,
+        choices=PLATFORM_CHOICES,
+        default=IOS,
+        db_index=True,
+        verbose_name=_('Platform')
+    )
 
     def __str__(self):
         return self.device_library_identifier
@@ -100,22 +202,58 @@ class Registration(models.Model):
     class Meta:
         ordering = ['-pk']
         unique_together = [['pass_object', 'device']]
+        indexes = [
+            # passes registered on a device
+            models.Index(
+                fields=['device', 'pass_object'],
+                name='wallets_reg_device_pass_idx'
+            ),
+        ]
         verbose_name = _('Relation: pass - device')
         verbose_name_plural = _('Relations: pass - device')
 
 
 class Log(models.Model):
     """
-    Logs that are sent by devices
+    Logs that are sent by devices, a repeated message is counted
+    in the row of its first occurrence
     """
     message = models.TextField(
         verbose_name=_('Message')
     )
+    message_hash = models.CharField(
+        max_length=40,
+        unique=True,
+        editable=False,
+        verbose_name=_('Message hash')
+    )
+    count = models.PositiveIntegerField(
+        default=1,
+        verbose_name=_('Occurrences')
+    )
+    first_seen = models.DateTimeField(
+        default=datetime.now,
+        verbose_name=_('First seen at')
+    )
+    last_seen = models.DateTimeField(
+        default=datetime.now,
+        db_index=True,
+        verbose_name=_('Last seen at')
+    )
+
+    @staticmethod
+    def hash_message(message: str) -> str:
+        return hashlib.sha1(message.encode()).hexdigest()
+
+    def save(self, *args, **kwargs):
+        if not self.message_hash:
+            self.message_hash = self.hash_message(self.message)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.message[:50]
 
     class Meta:
-        ordering = ['-pk']
+        ordering = ['-last_seen']
         verbose_name = _('Log')
         verbose_name_plural = _('Logs')
@@ -0,0 +1,99 @@
+"""
+Removal of devices whose push tokens are rejected by the push services,
+they belong to uninstalled apps or deleted passes
+"""
+import logging
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Device
+from .models import Registration
+
+logger = logging.getLogger(__name__)
+
+# reasons of APNs for 400 answers to tokens that will never be valid,
+# they are also given to every token when the environment (sandbox or
+# production) or the topic is wrong
+APNS_INVALID_REASONS = {
+    'BadDeviceToken',
+    'DeviceTokenNotForTopic',
+    'Unregistered',
+}
+
+# counts of pruned tokens, registrations and devices of the process
+stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def invalid_apple_tokens(results) -> list:
+    """
+    APNs answers 410 for tokens that are no longer active, the 400
+    answers are trusted only when other tokens of the batch were accepted
+    """
+    unregistered = [
+        result.token for result in results if result.status == 410
+    ]
+    rejected = [
+        result.token for result in results
+        if result.status == 400 and result.reason in APNS_INVALID_REASONS
+    ]
+    if rejected and not any(result.status == 200 for result in results):
+        logger.warning(
+            'APNs rejected all the %d tokens of a batch, check '
+            'WALLET_APNS_URL and the pass type certificate',
+            len(rejected)
+        )
+        rejected = []
+    return unregistered + rejected
+
+
+def invalid_android_tokens(results) -> list:
+    """
+    Only the statuses WalletUnion gives to tokens themselves count, the
+    status of a request (e.g. 404 of a wrong URL) does not
+    """
+    return [
+        result.token for result in results
+        if result.per_token and result.status in (404, 410)
+    ]
+
+
+def prune_tokens(push_tokens, batch_size=500) -> Counter:
+    """
+    Delete the registrations and devices of push tokens in batches,
+    return the numbers of deleted rows
+    """
+    push_tokens = list(push_tokens)
+    pruned = Counter()
+    for i in range(0, len(push_tokens), batch_size):
+        batch = push_tokens[i:i + batch_size]
+        with transaction.atomic():
+            device_ids = list(
+                Device.objects.filter(
+                    push_token__in=batch
+                ).values_list('pk', flat=True)
+            )
+            pruned['registrations'] += Registration.objects.filter(
+                device_id__in=device_ids
+            ).delete()[0]
+            pruned['devices'] += Device.objects.filter(
+                pk__in=device_ids
+            ).delete()[1].get(Device._meta.label, 0)
+        pruned['tokens'] += len(batch)
+
+    with _stats_lock:
+        stats.update(pruned)
+    return pruned
+
+
+def prune_results(results, invalid_tokens) -> Counter:
+    """Prune the tokens of push results rejected by the service"""
+    if not getattr(settings, 'WALLET_PRUNE_INVALID_TOKENS', True):
+        return Counter()
+    push_tokens = invalid_tokens(results)
+    if not push_tokens:
+        return Counter()
+    return prune_tokens(push_tokens)
@@ -0,0 +1,253 @@
+"""
+Clients of the push notification services
+
+Passes are updated with an empty notification to the pass type topic,
+the device then asks the web service for the changed passes
+https://developer.apple.com/library/archive/documentation/UserExperience/Conceptual/PassKit_PG/Updating.html
+"""
+import http.client
+import json
+import os
+import queue
+import ssl
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import httpx  # in case a user has httpx[http2] installed
+except ImportError:
+    httpx = None
+
+
+APNS_URL = 'https://api.push.apple.com'
+
+# The outcome of a notification, status is the HTTP status code or None if
+# the service could not be reached, reason is the error the service returned.
+# per_token is False when status is the one of a whole request, which
+# says nothing about the token itself
+PushResult = namedtuple(
+    'PushResult',
+    ['token', 'status', 'reason', 'per_token'],
+    defaults=[True]
+)
+
+
+def ssl_context(certificate, key, password=None, verify=True):
+    """
+    Return the TLS context of an APNs connection, authenticated by the
+    certificate and verifying the server with verify, True for the CAs
+    of httpx, False for none, or the path of a CA bundle or directory
+    """
+    if isinstance(verify, (str, os.PathLike)):
+        context = ssl.create_default_context()
+        if os.path.isdir(verify):
+            context.load_verify_locations(capath=verify)
+        else:
+            context.load_verify_locations(cafile=verify)
+    else:
+        context = httpx.create_ssl_context(verify=verify)
+    context.load_cert_chain(certificate, key, password or None)
+    return context
+
+
+class APNsClient:
+    """
+    Client of the HTTP/2 APNs provider API
+
+    Notifications are sent concurrently as streams of one long-lived
+    TLS connection, the client is shared by the tasks of a worker
+    """
+
+    def __init__(
+            self,
+            topic,
+            certificate,
+            key,
+            password=None,
+            url=APNS_URL,
+            concurrency=100,
+            timeout=10.0,
+            verify=True
+    ):
+        if httpx is None:
+            raise ImproperlyConfigured(
+                'httpx[http2] has to be installed to send notifications to APNs'
+            )
+        self.topic = topic
+        self.url = url.rstrip('/')
+        self.client = httpx.Client(
+            http2=True,
+            verify=ssl_context(certificate, key, password, verify),
+            timeout=timeout,
+        )
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def send(self, push_token: str) -> PushResult:
+        try:
+            response = self.client.post(
+                '{}/3/device/{}'.format(self.url, push_token),
+                headers={'apns-topic': self.topic},
+                content=b'{}',
+            )
+        except httpx.HTTPError as e:
+            return PushResult(push_token, None, str(e))
+
+        reason = None
+        if response.status_code != 200:
+            try:
+                reason = response.json().get('reason')
+            except ValueError:
+                reason = response.text
+        return PushResult(push_token, response.status_code, reason)
+
+    def send_many(self, push_tokens) -> list:
+        return list(self.executor.map(self.send, push_tokens))
+
+    def close(self):
+        self.executor.shutdown()
+        self.client.close()
+
+
+@lru_cache(maxsize=None)
+def get_apns_client() -> APNsClient:
+    """Return the APNs client of the process"""
+    return APNsClient(
+        topic=settings.WALLET_PASS_TYPE_ID,
+        certificate=settings.WALLET_CERTIFICATE_PATH,
+        key=settings.WALLET_KEY_PATH,
+        password=settings.WALLET_PASSWORD,
+        url=getattr(settings, 'WALLET_APNS_URL', APNS_URL),
+        concurrency=getattr(settings, 'WALLET_APNS_CONCURRENCY', 100),
+        verify=getattr(settings, 'WALLET_APNS_VERIFY', True),
+    )
+
+
+class AndroidClient:
+    """
+    Client of the WalletUnion push service
+
+    Tokens are sent in chunks, one request per chunk, over a pool of
+    keep-alive connections
+    """
+
+    def __init__(
+            self,
+            url,
+            api_key,
+            pass_type_id,
+            chunk_size=1000,
+            timeout=10.0
+    ):
+        parts = urlsplit(url)
+        self.connection_class = (
+            http.client.HTTPSConnection if parts.scheme == 'https'
+            else http.client.HTTPConnection
+        )
+        self.netloc = parts.netloc
+        self.path = parts.path or '/'
+        self.api_key = api_key
+        self.pass_type_id = pass_type_id
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self._connections = queue.LifoQueue()
+
+    def _post(self, body: bytes):
+        headers = {
+            'Authorization': self.api_key,
+            'Content-Type': 'application/json',
+        }
+        # a pooled connection may have been closed by the server while
+        # idle, then the request is repeated once over a new one
+        for attempt in range(2):
+            try:
+                connection = self._connections.get_nowait()
+            except queue.Empty:
+                connection = self.connection_class(
+                    self.netloc,
+                    timeout=self.timeout
+                )
+            try:
+                connection.request('POST', self.path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if attempt:
+                    raise
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                self._connections.put(connection)
+            return response.status, data
+
+    def _send_chunk(self, push_tokens) -> list:
+        body = json.dumps({
+            'passTypeIdentifier': self.pass_type_id,
+            'pushTokens': push_tokens,
+        }).encode()
+        try:
+            status, data = self._post(body)
+        except (http.client.HTTPException, OSError) as e:
+            return [
+                PushResult(token, None, str(e), per_token=False)
+                for token in push_tokens
+            ]
+        return parse_android_response(push_tokens, status, data)
+
+    def send_many(self, push_tokens) -> list:
+        push_tokens = list(push_tokens)
+        results = []
+        for i in range(0, len(push_tokens), self.chunk_size):
+            results.extend(
+                self._send_chunk(push_tokens[i:i + self.chunk_size])
+            )
+        return results
+
+    def send(self, push_token: str) -> PushResult:
+        return self._send_chunk([push_token])[0]
+
+
+def parse_android_response(push_tokens, status, data) -> list:
+    """
+    Return the result of every token of a request, tokens without an
+    integer status in a JSON object of token statuses in the answer get
+    the status of the request with per_token False
+    """
+    reason = data.decode(errors='replace') if status >= 300 else None
+    try:
+        token_statuses = json.loads(data)
+    except ValueError:
+        token_statuses = None
+    if not isinstance(token_statuses, dict):
+        token_statuses = {}
+    results = []
+    for token in push_tokens:
+        token_status = token_statuses.get(token)
+        # an answer of another format, e.g. {token: "ok"}, is no status
+        if isinstance(token_status, int) and not isinstance(
+                token_status,
+                bool
+        ):
+            results.append(PushResult(token, token_status, reason))
+        else:
+            results.append(
+                PushResult(token, status, reason, per_token=False)
+            )
+    return results
+
+
+@lru_cache(maxsize=None)
+def get_android_client() -> AndroidClient:
+    """Return the WalletUnion client of the process"""
+    return AndroidClient(
+        url=settings.WALLET_ANDROID_HOST,
+        api_key=settings.WALLET_ANDROID_API_KEY,
+        pass_type_id=settings.WALLET_PASS_TYPE_ID,
+        chunk_size=getattr(settings, 'WALLET_ANDROID_CHUNK_SIZE', 1000),
+    )
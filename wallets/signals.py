@@ -1,10 +1,8 @@
 from django.conf import settings
+from django.db import transaction
 from django.db.models.signals import post_save
 
-from .models import Registration
-
-from .tasks import pass_push_apple
-from .tasks import pass_push_android
+from .tasks import schedule_pass_push
 
 
 def post_save_signal_pass_push(
@@ -14,24 +12,14 @@ def post_save_signal_pass_push(
 ):
     """After saving passes"""
 
-    # Update registered devices
+    # nothing to update on devices
+    if not getattr(instance, 'content_changed', True):
+        return
 
-    registrations = Registration.objects.filter(pass_object=instance)
-    if registrations.exists():
-        for registration in registrations:
-            try:
-                # android tokens are longer
-                if len(registration.device.push_token) > 100:
-                    pass_push_android.delay(
-                        registration.device.push_token
-                    )
-                else:
-                    # pass_push_apple(pass_)
-                    pass_push_apple.delay(
-                        registration.device.push_token
-                    )
-            except Exception as e:
-                print(e)
+    # Update registered devices, once the pass is committed so
+    # they download the new version
+    pass_id = instance.pk
+    transaction.on_commit(lambda: schedule_pass_push(pass_id))
 
 
 if settings.WALLET_ENABLE_NOTIFICATIONS:
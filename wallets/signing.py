@@ -0,0 +1,178 @@
+"""
+Signing of pass manifests
+
+A pass is signed with a detached PKCS#7 signature of its manifest.json in
+DER format, the signer certificate and the Apple WWDR intermediate
+certificate are embedded into it
+https://developer.apple.com/library/archive/documentation/UserExperience/Conceptual/PassKit_PG/Creating.html
+"""
+import os
+import subprocess
+from functools import lru_cache
+
+from django.conf import settings
+
+try:
+    # in case a user has cryptography installed
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.serialization import pkcs7
+except ImportError:
+    pkcs7 = None
+
+
+OPENSSL = 'openssl'
+PKCS7 = 'pkcs7'
+
+
+class SignatureError(Exception):
+    """The manifest could not be signed"""
+
+
+class OpenSSLSigner:
+    """
+    Sign manifests with the openssl binary, one process per signature
+    """
+
+    def __init__(self, certificate, key, wwdr_certificate, password):
+        self.certificate = certificate
+        self.key = key
+        self.wwdr_certificate = wwdr_certificate
+        self.password = password
+
+    def sign(self, manifest: bytes) -> bytes:
+        openssl_cmd = [
+            'openssl',
+            'smime',
+            '-binary',
+            '-sign',
+            '-certfile',
+            self.wwdr_certificate,
+            '-signer',
+            self.certificate,
+            '-inkey',
+            self.key,
+            '-outform',
+            'DER',
+        ]
+        env = None
+        if self.password:
+            # not passed as an argument to keep it out of the process list
+            env = dict(os.environ, WALLET_PASSWORD=self.password)
+            openssl_cmd += ['-passin', 'env:WALLET_PASSWORD']
+        process = subprocess.Popen(
+            openssl_cmd,
+            stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+            env=env,
+        )
+        der, error = process.communicate(manifest)
+        if process.returncode != 0:
+            raise SignatureError(error)
+
+        return der
+
+
+class PKCS7Signer:
+    """
+    Sign manifests inside the process, the certificates and the key are
+    loaded and decrypted once
+    """
+
+    def __init__(self, certificate, key, wwdr_certificate, password):
+        if pkcs7 is None:
+            raise SignatureError(
+                'cryptography has to be installed to sign passes in-process'
+            )
+        with open(certificate, 'rb') as f:
+            self.certificate = x509.load_pem_x509_certificate(f.read())
+        with open(wwdr_certificate, 'rb') as f:
+            self.wwdr_certificate = x509.load_pem_x509_certificate(f.read())
+        with open(key, 'rb') as f:
+            key_data = f.read()
+        try:
+            self.key = serialization.load_pem_private_key(
+                key_data,
+                password=password.encode() if password else None
+            )
+        except TypeError as e:
+            if not password:
+                # the key is encrypted and no password is set
+                raise SignatureError(e)
+            # the password is set, but the key is not encrypted
+            try:
+                self.key = serialization.load_pem_private_key(
+                    key_data,
+                    password=None
+                )
+            except (TypeError, ValueError) as e:
+                raise SignatureError(e)
+        except ValueError as e:
+            raise SignatureError(e)
+
+    def sign(self, manifest: bytes) -> bytes:
+        return pkcs7.PKCS7SignatureBuilder().set_data(
+            manifest
+        ).add_signer(
+            self.certificate,
+            self.key,
+            hashes.SHA256()
+        ).add_certificate(
+            self.wwdr_certificate
+        ).sign(
+            serialization.Encoding.DER,
+            [
+                pkcs7.PKCS7Options.DetachedSignature,
+                pkcs7.PKCS7Options.Binary,
+            ]
+        )
+
+
+SIGNERS = {
+    OPENSSL: OpenSSLSigner,
+    PKCS7: PKCS7Signer,
+}
+
+
+def get_signer_mode() -> str:
+    """
+    Return the signing mode set by WALLET_SIGNER, by default passes are
+    signed in-process when cryptography is installed
+    """
+    mode = getattr(settings, 'WALLET_SIGNER', None)
+    if mode is None:
+        mode = OPENSSL if pkcs7 is None else PKCS7
+    if mode not in SIGNERS:
+        raise SignatureError('Unknown signer: {}'.format(mode))
+    return mode
+
+
+@lru_cache(maxsize=None)
+def _get_signer(mode, certificate, key, wwdr_certificate, password):
+    return SIGNERS[mode](certificate, key, wwdr_certificate, password)
+
+
+def get_signer(certificate, key, wwdr_certificate, password):
+    """
+    Return a signer for the given key material, signers are cached
+    for the life of the process
+    """
+    return _get_signer(
+        get_signer_mode(),
+        certificate,
+        key,
+        wwdr_certificate,
+        password
+    )
+
+
+def sign(manifest, certificate, key, wwdr_certificate, password) -> bytes:
+    """Return the detached DER signature of a manifest"""
+    return get_signer(
+        certificate,
+        key,
+        wwdr_certificate,
+        password
+    ).sign(manifest)
@@ -1,16 +1,24 @@
-import socket
-import ssl
-import json
-import struct
-import binascii
-import urllib
+import hashlib
+import time
 
 from django.conf import settings
+from django.core.cache import caches
+
+from .dispatch import dispatch
+from .models import Device
+from .models import Registration
+from .pruning import invalid_android_tokens
+from .pruning import invalid_apple_tokens
+from .pruning import prune_results
+from .push import get_android_client
+from .push import get_apns_client
 
 try:
     from celery import shared_task  # in case a user has celery installed
 except ImportError:
-    pass
+    def shared_task(func):
+        # without celery tasks are plain functions run by the dispatcher
+        return func
 
 
 @shared_task
@@ -21,67 +29,181 @@ def pass_push_apple(
     Send a push notification to APNS
     (Apple Push Notification service)
     """
+    result = get_apns_client().send(push_token)
+    prune_results([result], invalid_apple_tokens)
+    return result.status
 
-    pay_load = {}
 
-    cert = settings.WALLET_CERTIFICATE_PATH
+@shared_task
+def pass_push_apple_batch(
+        push_tokens: list,
+):
+    """
+    Send push notifications to APNS over one connection,
+    return the status code of every token
+    """
+    results = get_apns_client().send_many(push_tokens)
+    prune_results(results, invalid_apple_tokens)
+    return {result.token: result.status for result in results}
 
-    host = settings.WALLET_APN_HOST
 
-    pay_load = json.dumps(pay_load, separators=(',', ':'))
+@shared_task
+def pass_push_android(
+        push_token: str
+):
+    """
+    Send a push notification to Android
+    """
+    result = get_android_client().send(push_token)
+    prune_results([result], invalid_android_tokens)
+    return result.status
 
-    device_token = binascii.unhexlify(push_token)
-    fmt = "!BH32sH{}s".format(len(pay_load))
 
-    msg = struct.pack(
-        fmt,
-        0,
-        32,
-        device_token,
-        len(pay_load),
-        bytes(pay_load, "utf-8")
-    )
+@shared_task
+def pass_push_android_batch(
+        push_tokens: list,
+        retries: int = 3
+):
+    """
+    Send push notifications to Android in chunks, tokens that failed
+    because of the service or the network are sent again later
+    """
+    results = get_android_client().send_many(push_tokens)
+    prune_results(results, invalid_android_tokens)
+    failed = [
+        result.token for result in results
+        if result.status is None or result.status >= 500
+    ]
+    if failed and retries:
+        dispatch(
+            pass_push_android_batch,
+            failed,
+            retries - 1,
+            countdown=getattr(settings, 'WALLET_PUSH_RETRY_DELAY', 60)
+        )
+    return {result.token: result.status for result in results}
 
-    ssl_sock = ssl.wrap_socket(
-        socket.socket(
-            socket.AF_INET,
-            socket.SOCK_STREAM
-        ),
-        certfile=cert,
-    )
-    ssl_sock.connect(host)
 
-    ssl_sock.write(msg)
-    ssl_sock.close()
+def get_push_cache():
+    return caches[getattr(settings, 'WALLET_PUSH_CACHE', 'default')]
 
 
-@shared_task
-def pass_push_android(
-        push_token: str
+def get_debounce_window() -> int:
+    """Seconds to collapse repeated pushes in, 0 disables it"""
+    return getattr(settings, 'WALLET_PUSH_DEBOUNCE', 0)
+
+
+def schedule_pass_push(
+        pass_id: int
 ):
     """
-    Send a push notification to Android
+    Notify the devices of a saved pass after the debounce window,
+    saves of the pass within the window are notified together
     """
+    window = get_debounce_window()
+    if not window:
+        dispatch(pass_push_fan_out, pass_id)
+        return
+
+    cache = get_push_cache()
+    cache.set(
+        'wallets:push:saved:{}'.format(pass_id),
+        time.time(),
+        window * 2
+    )
+    if cache.add(
+            'wallets:push:scheduled:{}'.format(pass_id),
+            True,
+            window * 2
+    ):
+        dispatch(pass_push_fan_out, pass_id, countdown=window)
 
-    url = settings.WALLET_ANDROID_HOST
-    hdr = {
-        'Authorization': settings.WALLET_ANDROID_API_KEY,
-        'Content-Type': 'application/json',
-    }
-    data = {
-        "passTypeIdentifier": settings.WALLET_PASS_TYPE_ID,
-        "pushTokens": [
-            push_token,
-        ]
+
+def not_recently_pushed(push_tokens, since: float) -> list:
+    """
+    Drop the tokens that were already pushed after a time (a device
+    fetches all its updated passes after one push), remember the others
+    """
+    window = get_debounce_window()
+    if not window:
+        return push_tokens
+
+    cache = get_push_cache()
+    keys = {
+        'wallets:push:token:{}'.format(
+            hashlib.sha1(push_token.encode()).hexdigest()
+        ): push_token
+        for push_token in push_tokens
     }
-    print(json.dumps(data))
-    data = json.dumps(data).encode()
-
-    req = urllib.request.Request(
-        url,
-        headers=hdr,
-        data=data,
-        method='POST'
+    pushed = cache.get_many(list(keys))
+    fresh = [
+        key for key in keys
+        if key not in pushed or pushed[key] < since
+    ]
+    cache.set_many(dict.fromkeys(fresh, time.time()), window)
+    return [keys[key] for key in fresh]
+
+
+def send_push_tokens(push_tokens, platform, since: float = None):
+    """
+    Enqueue notifications for push tokens of a platform in batches
+    of WALLET_PUSH_CHUNK_SIZE tokens, WALLET_PUSH_STAGGER seconds apart,
+    tokens pushed after since are skipped
+    """
+    chunk_size = getattr(settings, 'WALLET_PUSH_CHUNK_SIZE', 1000)
+    task = (
+        pass_push_android_batch if platform == Device.ANDROID
+        else pass_push_apple_batch
     )
-    response = urllib.request.urlopen(req)
-    response.read()
+    if since is None:
+        since = time.time()
+
+    # the devices call back as soon as they are notified, the chunks
+    # are spread over time so they do not all call at once
+    stagger = getattr(settings, 'WALLET_PUSH_STAGGER', 0)
+    countdown = 0
+
+    def enqueue(chunk):
+        nonlocal countdown
+        chunk = not_recently_pushed(chunk, since)
+        if chunk:
+            dispatch(task, chunk, countdown=countdown or None)
+            countdown += stagger
+
+    chunk = []
+    for push_token in push_tokens:
+        chunk.append(push_token)
+        if len(chunk) == chunk_size:
+            enqueue(chunk)
+            chunk = []
+    if chunk:
+        enqueue(chunk)
+
+
+@shared_task
+def pass_push_fan_out(
+        pass_id: int
+):
+    """
+    Notify all the devices registered for a pass
+    """
+    since = None
+    if get_debounce_window():
+        # saves from now on are notified by the next fan-out
+        cache = get_push_cache()
+        cache.delete('wallets:push:scheduled:{}'.format(pass_id))
+        since = cache.get('wallets:push:saved:{}'.format(pass_id))
+
+    chunk_size = getattr(settings, 'WALLET_PUSH_CHUNK_SIZE', 1000)
+    for platform, _ in Device.PLATFORM_CHOICES:
+        send_push_tokens(
+            Registration.objects.filter(
+                pass_object_id=pass_id,
+                device__platform=platform
+            ).order_by().values_list(
+                'device__push_token',
+                flat=True
+            ).iterator(chunk_size=chunk_size),
+            platform,
+            since
+        )
@@ -0,0 +1,110 @@
+"""
+Pass templates: pass.json and the manifest of passes that share their
+layout are rendered once, every pass only fills in its own values
+"""
+import hashlib
+import json
+import re
+
+from .lib import Pass
+from .lib import pass_handler
+
+# a slot is rendered as a JSON string of its name between NUL characters
+SLOT_PATTERN = re.compile(r'"\\u0000(\w+)\\u0000"')
+
+
+class Slot:
+    """A value of a template that differs per pass, e.g. Slot('balance')"""
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'Slot({!r})'.format(self.name)
+
+
+def _render_slot(obj):
+    if isinstance(obj, Slot):
+        return '\x00{}\x00'.format(obj.name)
+    return pass_handler(obj)
+
+
+class PassTemplate:
+    """
+    A pass whose variable values are Slots, the serial number is always
+    one. pass.json is split around the slots and the manifest entries of
+    the files are computed once.
+    """
+
+    def __init__(self, pass_: Pass):
+        pass_json = json.dumps(
+            pass_.json_dict(),
+            default=_render_slot,
+            separators=(',', ':')
+        )
+        # literal parts of pass.json at even indexes, slot names at odd ones
+        self.parts = SLOT_PATTERN.split(pass_json)
+        self.slots = set(self.parts[1::2])
+        if 'serial_number' not in self.slots:
+            raise ValueError('The serial number of a template must be a slot')
+
+        self.files = dict(pass_._files)
+        # the manifest of a pass is {"pass.json": ..., <these entries>}
+        hashes = json.dumps(
+            {name: asset.sha1 for name, asset in self.files.items()}
+        )
+        self.manifest_tail = (
+            ', ' + hashes[1:] if self.files else hashes[1:]
+        ).encode('utf-8')
+
+    def render(self, values: dict) -> bytes:
+        """Return pass.json with the values of the slots"""
+        missing = self.slots - values.keys()
+        if missing:
+            raise KeyError(
+                'No values for {}'.format(', '.join(sorted(missing)))
+            )
+        parts = self.parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = json.dumps(
+                values[parts[i]],
+                default=pass_handler,
+                separators=(',', ':')
+            )
+        return ''.join(parts).encode('utf-8')
+
+    def render_manifest(self, pass_json: bytes) -> bytes:
+        return b'{"pass.json": "%s"%s' % (
+            hashlib.sha1(pass_json).hexdigest().encode('ascii'),
+            self.manifest_tail
+        )
+
+    def pass_(self, **values) -> 'TemplatePass':
+        """Return a pass of the template to create, e.g. in create_many"""
+        return TemplatePass(self, values)
+
+
+class TemplatePass(Pass):
+    """
+    A pass rendered from a template, files can be added to it as to
+    any pass
+    """
+
+    def __init__(self, template: PassTemplate, values: dict):
+        self.template = template
+        self.values = values
+        self.serial_number = values['serial_number']
+        self._files = dict(template.files)
+        self._hashes = {}
+
+    def json_dict(self):
+        return json.loads(self._create_pass_json())
+
+    def _create_pass_json(self):
+        return self.template.render(self.values)
+
+    def _create_manifest(self, pass_json):
+        if self._files != self.template.files:  # files were added
+            return super()._create_manifest(pass_json)
+        return self.template.render_manifest(pass_json)
@@ -0,0 +1,256 @@
+"""
+Load shedding of the web service for the burst of device requests
+that follows a mass push
+"""
+import asyncio
+import math
+import random
+import threading
+import time
+from functools import lru_cache
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+
+class Throttle:
+    """
+    Sliding window counters kept in a shared Django cache, one per pass
+    type and one per device. A request is counted in the window of its
+    period, the count of the previous window weighs as much as it still
+    overlaps the last period seconds. Requests beyond rate * period in
+    the last period are answered 503 and not counted, also at the edge
+    of two windows.
+
+    The cache increments counters atomically but cannot update a token
+    bucket (tokens, time) atomically, so the refill is approximated by
+    the weight of the previous window.
+    """
+
+    def __init__(
+            self,
+            cache='default',
+            pass_type_rate=500,
+            device_rate=5,
+            period=1
+    ):
+        self.cache = caches[cache]
+        self.pass_type_rate = pass_type_rate
+        self.device_rate = device_rate
+        self.period = period
+
+    def _limits(self, pass_type_id, device_library_id) -> list:
+        limits = []
+        if device_library_id and self.device_rate:
+            limits.append((
+                'wallets:throttle:device:{}'.format(device_library_id),
+                self.device_rate * self.period
+            ))
+        if pass_type_id and self.pass_type_rate:
+            limits.append((
+                'wallets:throttle:type:{}'.format(pass_type_id),
+                self.pass_type_rate * self.period
+            ))
+        return limits
+
+    def _windows(self, pass_type_id, device_library_id) -> tuple:
+        """
+        Return the weight of the previous window and the (current key,
+        previous key, size) of every limit
+        """
+        window, elapsed = divmod(time.time(), self.period)
+        window = int(window)
+        windows = [
+            (
+                '{}:{}'.format(key, window),
+                '{}:{}'.format(key, window - 1),
+                size
+            )
+            for key, size in self._limits(pass_type_id, device_library_id)
+        ]
+        return 1 - elapsed / self.period, windows
+
+    def retry_after(self) -> int:
+        """
+        Seconds until the window is over, spread over another period so
+        the rejected devices do not come back all at once
+        """
+        remaining = self.period - time.time() % self.period
+        return math.ceil(remaining + random.uniform(0, self.period))
+
+    def check(self, pass_type_id=None, device_library_id=None) -> int:
+        """Count a request, return 0 or the seconds to retry after"""
+        weight, windows = self._windows(pass_type_id, device_library_id)
+        previous = self.cache.get_many([key for _, key, _ in windows])
+        taken_keys = []
+        for key, previous_key, size in windows:
+            self.cache.add(key, 0, self.period * 2)
+            try:
+                taken = self.cache.incr(key)
+            except ValueError:  # expired since it was added
+                taken = 1
+                self.cache.set(key, taken, self.period * 2)
+            taken_keys.append(key)
+            if previous.get(previous_key, 0) * weight + taken > size:
+                # only served requests count, a herd that keeps coming
+                # back is not rejected for ever
+                for taken_key in taken_keys:
+                    try:
+                        self.cache.decr(taken_key)
+                    except ValueError:
+                        pass
+                return self.retry_after()
+        return 0
+
+    async def acheck(self, pass_type_id=None, device_library_id=None) -> int:
+        """Count a request, return 0 or the seconds to retry after"""
+        weight, windows = self._windows(pass_type_id, device_library_id)
+        previous = await self.cache.aget_many(
+            [key for _, key, _ in windows]
+        )
+        taken_keys = []
+        for key, previous_key, size in windows:
+            await self.cache.aadd(key, 0, self.period * 2)
+            try:
+                taken = await self.cache.aincr(key)
+            except ValueError:  # expired since it was added
+                taken = 1
+                await self.cache.aset(key, taken, self.period * 2)
+            taken_keys.append(key)
+            if previous.get(previous_key, 0) * weight + taken > size:
+                # only served requests count, a herd that keeps coming
+                # back is not rejected for ever
+                for taken_key in taken_keys:
+                    try:
+                        await self.cache.adecr(taken_key)
+                    except ValueError:
+                        pass
+                return self.retry_after()
+        return 0
+
+
+@lru_cache(maxsize=None)
+def get_throttle():
+    """
+    Return the throttle set by WALLET_THROTTLE or None, e.g.
+    {'cache': 'default', 'pass_type_rate': 500, 'device_rate': 5}
+    """
+    options = getattr(settings, 'WALLET_THROTTLE', None)
+    if options is None:
+        return None
+    return Throttle(**options)
+
+
+def throttled_response(retry_after: int) -> HttpResponse:
+    response = HttpResponse(status=503)
+    response['Retry-After'] = retry_after
+    return response
+
+
+def throttled(view):
+    """
+    Answer 503 with Retry-After to the requests of a view that are over
+    the budget of their pass type or device
+    """
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            throttle = get_throttle()
+            if throttle is not None:
+                retry_after = await throttle.acheck(
+                    kwargs.get('pass_type_id'),
+                    kwargs.get('device_library_id')
+                )
+                if retry_after:
+                    return throttled_response(retry_after)
+            return await view(request, *args, **kwargs)
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        throttle = get_throttle()
+        if throttle is not None:
+            retry_after = throttle.check(
+                kwargs.get('pass_type_id'),
+                kwargs.get('device_library_id')
+            )
+            if retry_after:
+                return throttled_response(retry_after)
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one execution, the first
+    caller runs it and the others wait for its result
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    async def ado(self, key, func, *args):
+        """do() for coroutine functions, shared within an event loop"""
+        loop = asyncio.get_running_loop()
+        key = (id(loop), key)
+        future = self._futures.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = self._futures[key] = loop.create_future()
+        try:
+            result = await func(*args)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # the waiters get the error, nobody has to retrieve it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._futures[key]
+
+
+# lookups of the web service shared by concurrent requests of the process
+flight = SingleFlight()
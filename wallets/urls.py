@@ -2,12 +2,21 @@
 API urls that are built in accordance to
 https://developer.apple.com/library/archive/documentation/PassKit/Reference/PassKit_WebService/WebService.html
 """
+from django.conf import settings
 from django.urls import path
 
-from .views import handle_device
-from .views import get_serial_numbers
-from .views import get_latest_version
-from .views import log_info
+from .models import Device
+
+if getattr(settings, 'WALLET_ASYNC_VIEWS', False):
+    from .async_views import handle_device
+    from .async_views import get_serial_numbers
+    from .async_views import get_latest_version
+    from .async_views import log_info
+else:
+    from .views import handle_device
+    from .views import get_serial_numbers
+    from .views import get_latest_version
+    from .views import log_info
 
 
 urlpatterns = [
@@ -20,6 +29,7 @@ urlpatterns = [
     path(
         'v1/devices/<str:device_library_id>/registrations_attido/<str:pass_type_id>/<str:serial_number>',
         handle_device,  # register and unregister a device
+        {'platform': Device.ANDROID},
         name='handle_device'
     ),
     path(
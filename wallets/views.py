@@ -1,19 +1,27 @@
+import hashlib
 import json
+import math
 from datetime import datetime
 
 import django.dispatch
 from django.conf import settings
+from django.db import transaction
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import condition
+from django.http import FileResponse
 from django.http import HttpRequest
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.db.models import QuerySet
-from django.db.models import Max
 
 from .models import Device
 from .models import Registration
-from .models import Log
+from .models import get_pass_model
+from .cache import PassMetadata
+from .cache import get_metadata_cache
+from .logs import get_log_buffer
+from .logs import save_logs
+from .throttling import throttled
 
 
 FORMAT = '%Y-%m-%d %H:%M:%S'
@@ -42,87 +50,229 @@ def get_pass(
 ) -> settings.PASS_MODEL:
     """Return a pass or 404"""
     return get_object_or_404(
-        settings.PASS_MODEL,
+        get_pass_model(),
         pass_type_id=pass_type_id,
         serial_number=serial_number
     )
 
 
+def get_pass_metadata(
+        request: HttpRequest,
+        pass_type_id: str,
+        serial_number: str
+) -> PassMetadata:
+    """Return the cached metadata of a pass or 404"""
+    return get_metadata_cache().get(request, pass_type_id, serial_number)
+
+
+def get_pass_storage():
+    """Return the storage of pass archives"""
+    return get_pass_model()._meta.get_field('data').storage
+
+
 def latest_pass(
         request: HttpRequest,
         pass_type_id: str,
         serial_number: str
 ) -> datetime:
-    return get_pass(
+    return get_pass_metadata(
+        request,
         pass_type_id,
         serial_number
     ).utime
 
 
+def metadata_etag(metadata: PassMetadata) -> str:
+    """
+    Return the ETag of a pass archive from the digest saved with the
+    pass, the archive itself is not read
+    """
+    if not metadata.data:
+        return None
+    return hashlib.sha1('{}:{}:{}'.format(
+        metadata.content_digest,
+        metadata.data,
+        metadata.utime.isoformat()
+    ).encode()).hexdigest()
+
+
+def pass_etag(
+        request: HttpRequest,
+        pass_type_id: str,
+        serial_number: str
+) -> str:
+    return metadata_etag(
+        get_pass_metadata(request, pass_type_id, serial_number)
+    )
+
+
+def pass_response(name: str) -> HttpResponse:
+    """
+    Return a pass archive, streamed from the storage or sent by
+    the front proxy if WALLET_SENDFILE_HEADER is set
+    """
+    sendfile_header = getattr(settings, 'WALLET_SENDFILE_HEADER', None)
+    if sendfile_header:
+        response = HttpResponse(content_type='application/vnd.apple.pkpass')
+        if sendfile_header == 'X-Accel-Redirect':
+            # an internal nginx location that points to the storage
+            response[sendfile_header] = '{}{}'.format(
+                getattr(settings, 'WALLET_SENDFILE_PREFIX', '/'),
+                name
+            )
+        else:  # X-Sendfile, X-LIGHTTPD-send-file
+            response[sendfile_header] = get_pass_storage().path(name)
+        response['Content-Disposition'] = 'attachment; filename=pass.pkpass'
+        return response
+
+    return FileResponse(
+        get_pass_storage().open(name, 'rb'),
+        as_attachment=True,
+        filename='pass.pkpass',
+        content_type='application/vnd.apple.pkpass'
+    )
+
+
 @csrf_exempt
 def handle_device(
         request: HttpRequest,
         device_library_id: str,
         pass_type_id: str,
-        serial_number: str
+        serial_number: str,
+        platform: str = Device.IOS
 ):
     """
     Handle a device request, register or unregister it
     """
     # we already have this card
-    pass_ = get_pass(pass_type_id, serial_number)
+    metadata = get_pass_metadata(request, pass_type_id, serial_number)
 
-    if not is_authorized(request, pass_):
+    if not is_authorized(request, metadata):
         return HttpResponse(status=401)
 
     # registering a device
     if request.method == 'POST':
-        # if already registered
-        try:
-            Registration.objects.get(
-                pass_object=pass_,
-                device=Device.objects.get(
-                    device_library_identifier=device_library_id
-                )
-            )
+        body = json.loads(request.body)
+        created = register_device(
+            metadata.pk,
+            device_library_id,
+            body['pushToken'],
+            platform
+        )
+        if not created:  # already registered
             return HttpResponse(status=200)
-        except (Device.DoesNotExist, Registration.DoesNotExist):
-            body = json.loads(request.body)
 
-            new_device = Device(
-                device_library_identifier=device_library_id,
-                push_token=body['pushToken']
-            )
-            new_device.save()
-            new_registration = Registration(
-                pass_object=pass_,
-                device=new_device
+        if pass_registered.receivers:
+            pass_registered.send(
+                sender=get_pass(pass_type_id, serial_number)
             )
-            new_registration.save()
-
-            pass_registered.send(sender=pass_)
-            return HttpResponse(status=201)  # Created
+        return HttpResponse(status=201)  # Created
 
     elif request.method == 'DELETE':
-        try:
-            device = Device.objects.get(
-                device_library_identifier=device_library_id
-            )
-            old_registration = Registration.objects.filter(
-                pass_object=pass_,
-                device=device
-            )
-            old_registration.delete()
-            device.delete()
-            pass_unregistered.send(sender=pass_)
-            return HttpResponse(status=200)
-        except Device.DoesNotExist:
+        if not unregister_device(metadata.pk, device_library_id):
             return HttpResponse(status=404)
 
+        if pass_unregistered.receivers:
+            pass_unregistered.send(
+                sender=get_pass(pass_type_id, serial_number)
+            )
+        return HttpResponse(status=200)
+
     else:
         return HttpResponse(status=400)
 
 
+def register_device(
+        pass_id: int,
+        device_library_id: str,
+        push_token: str,
+        platform: str = Device.IOS
+) -> bool:
+    """
+    Register a device for a pass, a known device gets the new push token.
+    Return True if the registration is new
+    """
+    with transaction.atomic():
+        device, = Device.objects.bulk_create(
+            [
+                Device(
+                    device_library_identifier=device_library_id,
+                    push_token=push_token,
+                    platform=platform
+                )
+            ],
+            update_conflicts=True,
+            unique_fields=['device_library_identifier'],
+            update_fields=['push_token', 'platform']
+        )
+        if device.pk is None:  # the backend does not return upserted rows
+            device.pk = Device.objects.filter(
+                device_library_identifier=device_library_id
+            ).values_list('pk', flat=True).get()
+
+        _, created = Registration.objects.get_or_create(
+            pass_object_id=pass_id,
+            device_id=device.pk
+        )
+    return created
+
+
+def unregister_device(
+        pass_id: int,
+        device_library_id: str
+) -> bool:
+    """
+    Unregister a device from a pass, the device is deleted when it has
+    no passes left. Return False if it was not registered
+    """
+    with transaction.atomic():
+        deleted, _ = Registration.objects.filter(
+            pass_object_id=pass_id,
+            device__device_library_identifier=device_library_id
+        ).delete()
+        Device.objects.filter(
+            device_library_identifier=device_library_id,
+            registration=None
+        ).delete()
+    return bool(deleted)
+
+
+def device_passes(
+        device_library_id: str,
+        pass_type_id: str
+) -> QuerySet:
+    """Return the passes of a type registered on a device"""
+    return get_pass_model().objects.filter(
+        registration__device__device_library_identifier=device_library_id,
+        pass_type_id=pass_type_id
+    ).order_by()
+
+
+def latest_passes(
+        passes: QuerySet,
+        updated_since: datetime = None
+) -> QuerySet:
+    """
+    Return serial numbers and update times of all the passes updated
+    since a time, a device notified once fetches every one of them
+    """
+    if updated_since is not None:
+        passes = passes.filter(utime__gt=updated_since)
+    return passes.values_list('serial_number', 'utime')
+
+
+def serial_numbers_response(rows) -> HttpResponse:
+    response_data = {
+        'lastUpdated': max(utime for _, utime in rows).strftime(FORMAT),
+        'serialNumbers': [serial_number for serial_number, _ in rows]
+    }
+    return HttpResponse(
+        json.dumps(response_data),
+        content_type="application/json"
+    )
+
+
+@throttled
 def get_serial_numbers(
         request: HttpRequest,
         device_library_id: str,
@@ -131,44 +281,24 @@ def get_serial_numbers(
     """
     Get the Serial Numbers for passes associated with a device
     """
-    device = get_object_or_404(
-        Device,
-        device_library_identifier=device_library_id
-    )
-    # get all the existing passes
-    passes = settings.PASS_MODEL.objects.filter(
-        registration__device=device,
-        pass_type_id=pass_type_id
-    )
-
-    if passes.count() == 0:
-        return HttpResponse(status=404)
-
+    passes = device_passes(device_library_id, pass_type_id)
+    updated_since = None
     if 'passesUpdatedSince' in request.GET:
-        passes: QuerySet = passes.filter(utime__gt=datetime.strptime(
+        updated_since = datetime.strptime(
             request.GET['passesUpdatedSince'], FORMAT
-        ))
-
-    if passes:
-        last_updated: datetime = passes.aggregate(Max('utime'))['utime__max']
-        serial_numbers = [
-            p.serial_number for p in passes.filter(
-                utime=last_updated
-            ).all()
-        ]
-        response_data = {
-            'lastUpdated': last_updated.strftime(FORMAT),
-            'serialNumbers': serial_numbers
-        }
-        return HttpResponse(
-            json.dumps(response_data),
-            content_type="application/json"
         )
-    else:
-        return HttpResponse(status=204)  # no content
 
+    rows = list(latest_passes(passes, updated_since))
+    if rows:
+        return serial_numbers_response(rows)
+    # the device or its passes are unknown
+    if not passes.exists():
+        return HttpResponse(status=404)
+    return HttpResponse(status=204)  # no content
 
-@condition(last_modified_func=latest_pass)
+
+@throttled
+@condition(etag_func=pass_etag, last_modified_func=latest_pass)
 def get_latest_version(
         request: HttpRequest,
         pass_type_id: str,
@@ -177,17 +307,12 @@ def get_latest_version(
     """
     Get the latest version of pass
     """
-    pass_ = get_pass(pass_type_id, serial_number)
+    metadata = get_pass_metadata(request, pass_type_id, serial_number)
 
-    if not is_authorized(request, pass_):
+    if not is_authorized(request, metadata):
         return HttpResponse(status=401)
 
-    response = HttpResponse(
-        pass_.data.read(),
-        content_type='application/vnd.apple.pkpass'
-    )
-    response['Content-Disposition'] = 'attachment; filename=pass.pkpass'
-    return response
+    return pass_response(metadata.data)
 
 
 @csrf_exempt
@@ -196,7 +321,15 @@ def log_info(request: HttpRequest):
     Log messages from devices
     """
     body = json.loads(request.body)
-    for message in body['logs']:
-        log = Log(message=message)
-        log.save()
+    log_buffer = get_log_buffer()
+    if log_buffer is None:
+        save_logs(body['logs'])
+    elif not log_buffer.add(body['logs']):
+        return log_buffer_full_response()
     return HttpResponse(status=200)
+
+
+def log_buffer_full_response() -> HttpResponse:
+    response = HttpResponse(status=503)
+    response['Retry-After'] = math.ceil(get_log_buffer().flush_interval)
+    return response